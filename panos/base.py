@@ -26,6 +26,7 @@ import inspect
 import itertools
 import re
 import sys
+import threading
 import time
 import xml.dom.minidom as minidom
 import xml.etree.ElementTree as ET
@@ -45,6 +46,103 @@ SELF = "/%s"
 ENTRY = "/entry[@name='%s']"
 MEMBER = "/member[text()='%s']"
 
+# Python 2 has no sys.intern(), in which case strings are left as-is.
+_intern = getattr(sys, "intern", lambda x: x)
+
+
+def _xml_round_trips(xml):
+    """Returns True if ``ET.fromstring()`` gives back the same XML bytes.
+
+    Not all values survive serializing:  the parser normalizes carriage
+    returns away, and characters or tag names that XML doesn't allow can't be
+    parsed at all.
+
+    """
+    try:
+        return ET.tostring(ET.fromstring(xml), encoding="utf-8") == xml
+    except ET.ParseError:
+        return False
+
+
+def _element_cache_value(value):
+    """Returns a snapshot of a param value for use in an element cache key.
+
+    Raises:
+        TypeError: If the value's type is not known to be safe to snapshot.
+
+    """
+    if value is None or isstring(value):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return tuple(_element_cache_value(x) for x in value)
+    elif isinstance(value, (bool, int, float)):
+        # These compare equal across types (True == 1 == 1.0), but render
+        # differently, so their type is kept too.
+        return (type(value), value)
+
+    raise TypeError("Cannot snapshot {0}".format(type(value)))
+
+
+# Every distinct ParamPath condition check is given a bit, so that the checks
+# an element needs are each done once, then tested against each param's mask.
+_CONDITION_BITS = {}
+_CONDITION_CHECKS = []
+_CONDITION_LOCK = threading.Lock()
+
+
+def _condition_bit(check):
+    """Returns the bit for a ``(key, value, is_set)`` condition check."""
+    try:
+        return _CONDITION_BITS[check]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable condition values can't be shared, so get their own bit.
+        with _CONDITION_LOCK:
+            _CONDITION_CHECKS.append(check)
+            return 1 << (len(_CONDITION_CHECKS) - 1)
+
+    with _CONDITION_LOCK:
+        if check not in _CONDITION_BITS:
+            _CONDITION_CHECKS.append(check)
+            _CONDITION_BITS[check] = 1 << (len(_CONDITION_CHECKS) - 1)
+        return _CONDITION_BITS[check]
+
+
+def _condition_state(settings, mask):
+    """Returns the bits of ``mask`` whose condition checks pass for ``settings``."""
+    state = 0
+    remaining = mask
+    while remaining:
+        bit = remaining & -remaining
+        remaining ^= bit
+        key, value, is_set = _CONDITION_CHECKS[bit.bit_length() - 1]
+        try:
+            setting = settings[key]
+        except KeyError:
+            # This condition references a param that does not exist and it is
+            # thus not needed
+            continue
+        try:
+            if setting in value:
+                state |= bit
+        except TypeError:
+            if not is_set and setting == value:
+                state |= bit
+
+    return state
+
+
+def _xml_start_tag(elm):
+    """Returns the serialized opening tag of ``elm``, ignoring its contents."""
+    empty = ET.tostring(ET.Element(elm.tag, elm.attrib), encoding="utf-8")
+    return empty[: empty.rindex(b"/")].rstrip() + b">"
+
+
+def _xml_end_tag(elm):
+    """Returns the serialized closing tag of ``elm``."""
+    return "</{0}>".format(elm.tag).encode("utf-8")
+
 
 # PanObject type
 class PanObject(object):
@@ -523,6 +621,93 @@ class PanObject(object):
             return parsed.toprettyxml(indent="\t", encoding="utf-8")
         return ET.tostring(self.element(), encoding="utf-8")
 
+    def element_stream(self, out, comparable=False):
+        """Write the XML of this PanObject and all its children to a file.
+
+        The output is the same as :meth:`element_str`, but the full tree is
+        never built:  each child is rendered and written in turn, so only one
+        child's XML is held in memory at a time.  Children that cache their
+        element reuse a current cache, but are not added to it.
+
+        Args:
+            out: A binary file-like object to write to.
+            comparable (bool): Element will be used in a comparison with another.
+
+        """
+        if type(self).element not in (PanObject.element, VersionedPanObject.element):
+            # Custom element() implementations are written out as-is.
+            out.write(ET.tostring(self.element(), encoding="utf-8"))
+            return
+
+        root = self.element(with_children=False, comparable=comparable)
+        layout = self._stream_layout()
+        if not layout or len(root) or root.text is not None:
+            # Nothing to stream, or children would be merged with this
+            # object's own XML, so fall back to building the whole tree.
+            out.write(
+                ET.tostring(self.element(comparable=comparable), encoding="utf-8")
+            )
+            return
+
+        out.write(_xml_start_tag(root))
+        self._write_stream_layout(out, layout, comparable)
+        out.write(_xml_end_tag(root))
+
+    def _stream_layout(self):
+        """Groups children under the elements ``_subelements()`` nests them in.
+
+        Returns:
+            list: Children and ``(tag, name, items)`` tuples for the enclosing
+            elements, in document order.  None if two children would be
+            merged together by ``xml_merge()``.
+
+        """
+        layout = []
+        claimed = {}
+        for child in self.children:
+            sections = child.XPATH.split("/")[1:]
+            if child.SUFFIX is None:
+                tag, name = sections.pop(), None
+            elif child.SUFFIX == ENTRY:
+                tag, name = "entry", child.uid
+            else:
+                tag, name = "member", child.uid
+            items, parent = layout, ()
+            for path in sections:
+                if path == "entry[@name='localhost.localdomain']":
+                    key = (parent, "entry", "localhost.localdomain")
+                else:
+                    key = (parent, path, None)
+                node = claimed.get(key)
+                if node is None:
+                    node = claimed[key] = (key[1], key[2], [])
+                    items.append(node)
+                elif not isinstance(node, tuple):
+                    return None
+                items, parent = node[2], key
+            key = (parent, tag, name)
+            if key in claimed:
+                return None
+            claimed[key] = child
+            items.append(child)
+
+        return layout
+
+    def _write_stream_layout(self, out, items, comparable):
+        for item in items:
+            if isinstance(item, tuple):
+                tag, name, subitems = item
+                elm = ET.Element(tag, {} if name is None else {"name": name})
+                out.write(_xml_start_tag(elm))
+                self._write_stream_layout(out, subitems, comparable)
+                out.write(_xml_end_tag(elm))
+            else:
+                out.write(item._stream_element(comparable))
+
+    def _stream_element(self, comparable):
+        """Returns this object's serialized XML, as written by ``element_stream()``."""
+        return ET.tostring(self.element(comparable=comparable), encoding="utf-8")
+
     def _root_element(self):
         if self.SUFFIX == ENTRY:
             return ET.Element("entry", {"name": self.uid})
@@ -2084,6 +2269,8 @@ class VersioningSupport(object):
 
     """
 
+    __slots__ = ("__profiles",)
+
     def __init__(self):
         self.__profiles = []
 
@@ -2151,6 +2338,8 @@ class VersioningSupport(object):
 
 
 class VersionedStubs(VersioningSupport):
+    __slots__ = ()
+
     def add_profile(self, version=None, *paths):
         """Adds the following stubs for the specified version.
 
@@ -2290,6 +2479,8 @@ class VersionedPanObject(PanObject):
     """
 
     _DEFAULT_NAME = None
+    _CACHE_ELEMENT = False
+    _CACHED_XPATHS_AND_STUBS = False
     _TEMPLATE_DEVICE_XPATH = "/config/devices/entry[@name='localhost.localdomain']"
     _TEMPLATE_VSYS_XPATH = _TEMPLATE_DEVICE_XPATH + "/vsys/entry[@name='{vsys}']"
     _TEMPLATE_MGTCONFIG_XPATH = "/config/mgt-config"
@@ -2304,8 +2495,9 @@ class VersionedPanObject(PanObject):
             setattr(self, self.NAME, name or self._DEFAULT_NAME)
         self.parent = None
         self.children = []
-        self._xpaths = ParentAwareXpath()
-        self._stubs = VersionedStubs()
+        if not self._CACHED_XPATHS_AND_STUBS:
+            self._xpaths = ParentAwareXpath()
+            self._stubs = VersionedStubs()
 
         self._setups()
 
@@ -2321,7 +2513,11 @@ class VersionedPanObject(PanObject):
 
         # Set all params to their default values initially
         for param in params:
-            param.value = param.default
+            if isinstance(param.default, (list, tuple)):
+                # Each object gets its own list, as defaults may be shared.
+                param.value = list(param.default)
+            else:
+                param.value = param.default
 
         # Handle positional params
         for value, param in zip(args, params):
@@ -2353,6 +2549,119 @@ class VersionedPanObject(PanObject):
         """
         pass
 
+    @classmethod
+    def _build_xpaths(cls, xpaths):
+        """Adds the xpath profiles for this class to ``xpaths``.
+
+        Classes whose xpaths do not vary per instance can add them here
+        instead of in ``_setup()``, then set ``self._xpaths`` to
+        ``self._cached_xpaths()``.  This is invoked only once per class.
+
+        Classes that set both ``self._xpaths`` and ``self._stubs`` this way
+        should also set ``_CACHED_XPATHS_AND_STUBS``, so that empty ones are
+        not created for every instance first.
+
+        Args:
+            xpaths (ParentAwareXpath): The xpaths to add profiles to.
+
+        """
+        pass
+
+    @classmethod
+    def _cached_xpaths(cls):
+        """Returns the :class:`panos.base.ParentAwareXpath` for this class.
+
+        The xpaths from ``_build_xpaths()`` are saved as ``_XPATHS_CACHE``
+        on the class and shared by all instances, so they must not be
+        modified afterwards.
+
+        """
+        xpaths = cls.__dict__.get("_XPATHS_CACHE")
+        if xpaths is None:
+            xpaths = ParentAwareXpath()
+            cls._build_xpaths(xpaths)
+            cls._XPATHS_CACHE = xpaths
+
+        return xpaths
+
+    @classmethod
+    def _build_stubs(cls, stubs):
+        """Adds the stub profiles for this class to ``stubs``.
+
+        This is the ``_stubs`` counterpart to ``_build_xpaths()``, used with
+        ``self._cached_stubs()``.
+
+        Args:
+            stubs (VersionedStubs): The stubs to add profiles to.
+
+        """
+        pass
+
+    @classmethod
+    def _cached_stubs(cls):
+        """Returns the :class:`panos.base.VersionedStubs` for this class.
+
+        The stubs from ``_build_stubs()`` are saved as ``_STUBS_CACHE`` on
+        the class and shared by all instances, so they must not be modified
+        afterwards.
+
+        """
+        stubs = cls.__dict__.get("_STUBS_CACHE")
+        if stubs is None:
+            stubs = VersionedStubs()
+            cls._build_stubs(stubs)
+            cls._STUBS_CACHE = stubs
+
+        return stubs
+
+    @classmethod
+    def _build_params(cls):
+        """Returns the :class:`panos.base.VersionedParamPath` list for this class.
+
+        Classes whose params do not vary per instance can define them
+        here instead of in ``_setup()``, then set ``self._params`` to
+        ``self._cached_params()``.  This is invoked only once per class.
+
+        """
+        return []
+
+    @classmethod
+    def _cached_params(cls):
+        """Returns per instance copies of the params from ``_build_params()``.
+
+        The params are built once and saved as ``_PARAMS_CACHE`` on the class.
+        Each instance gets shallow copies so that the param values are not
+        shared, while the versioned profiles are.
+
+        The param names are also saved as ``_PARAM_NAMES``, and the
+        ``ParamPath`` objects for each version seen as ``_PARAM_PATHS``, as
+        tuples parallel to ``_PARAMS_CACHE``.  These are only used for
+        objects whose ``self._params`` are still the copies returned here.
+
+        """
+        params = cls.__dict__.get("_PARAMS_CACHE")
+        if params is None:
+            params = tuple(cls._build_params())
+            cls._PARAM_NAMES = tuple(x.name for x in params)
+            cls._PARAM_PATHS = {}
+            cls._PARAMS_CACHE = params
+
+        # Call __copy__() directly, skipping copy.copy()'s type dispatch.
+        return tuple([x.__copy__() for x in params])
+
+    @classmethod
+    def _versioned_param_paths(cls, panos_version):
+        """Returns the ``ParamPath`` of each cached param for this version."""
+        paths = cls._PARAM_PATHS.get(panos_version)
+        if paths is None:
+            paths = tuple(
+                x._get_versioned_value(panos_version)
+                for x in cls.__dict__["_PARAMS_CACHE"]
+            )
+            cls._PARAM_PATHS[panos_version] = paths
+
+        return paths
+
     def _about_object(self):
         try:
             ans = dict((p.name, p.value) for p in self._params)
@@ -2436,12 +2745,19 @@ class VersionedPanObject(PanObject):
         except AttributeError:
             pass
 
-        paths = []
-        for param in params:
-            settings[param.name] = param.value
-            var_path = param._get_versioned_value(panos_version)
-            if var_path:
-                paths.append(var_path)
+        if self._has_cached_params(params):
+            # Params from _cached_params(), whose names and versioned paths
+            # are kept by the class in parallel tuples.
+            names = type(self).__dict__["_PARAM_NAMES"]
+            settings = dict(zip(names, [x.value for x in params]))
+            paths = [x for x in self._versioned_param_paths(panos_version) if x]
+        else:
+            paths = []
+            for param in params:
+                settings[param.name] = param.value
+                var_path = param._get_versioned_value(panos_version)
+                if var_path:
+                    paths.append(var_path)
 
         stubs = []
         try:
@@ -2451,6 +2767,24 @@ class VersionedPanObject(PanObject):
 
         return (paths, stubs, settings)
 
+    def _has_cached_params(self, params):
+        """Returns True if ``params`` are all copies made by ``_cached_params()``.
+
+        A subclass can replace some of the params after calling its parent's
+        ``_setup()``, so each param's profiles are checked against the cached
+        param's.
+
+        """
+        cached = type(self).__dict__.get("_PARAMS_CACHE")
+        if cached is None or len(cached) != len(params):
+            return False
+
+        for x, y in zip(params, cached):
+            if x._VersioningSupport__profiles is not y._VersioningSupport__profiles:
+                return False
+
+        return True
+
     def element(self, with_children=True, comparable=False):
         """Return an xml.etree.ElementTree for this object and its children.
 
@@ -2462,11 +2796,75 @@ class VersionedPanObject(PanObject):
             xml.etree.ElementTree for this object.
 
         """
+        # Classes with _CACHE_ELEMENT set reuse the last XML generated if
+        # nothing it depends on has changed.  Only the serialized XML is kept,
+        # which is far smaller than the element tree.
+        cache_key = None
+        if self._CACHE_ELEMENT and not (with_children and self.children):
+            cache_key, seen, cached = self._cached_element(comparable)
+            if cached:
+                return ET.fromstring(cached)
+
+        ans = self._build_element(with_children, comparable)
+
+        if cache_key is not None and cached is None:
+            # The XML is only serialized and kept once the same key is seen
+            # twice, so objects that change between renders don't pay for it.
+            # XML that doesn't round trip is never reused, which is recorded
+            # as empty bytes so that it is only checked once.
+            if seen:
+                xml = ET.tostring(ans, encoding="utf-8")
+                if not _xml_round_trips(xml):
+                    xml = b""
+                self._element_cache = (cache_key, xml)
+            else:
+                self._element_cache = (cache_key, None)
+
+        return ans
+
+    def _stream_element(self, comparable):
+        # Only reads the element cache:  filling it for every child streamed
+        # would keep the whole rulebase's XML around.
+        if type(self).element != VersionedPanObject.element:
+            return super(VersionedPanObject, self)._stream_element(comparable)
+
+        if self._CACHE_ELEMENT and not self.children:
+            cached = self._cached_element(comparable)[2]
+            if cached:
+                return cached
+
+        return ET.tostring(self._build_element(True, comparable), encoding="utf-8")
+
+    def _cached_element(self, comparable):
+        """Returns the element cache key, if the cache has it, and its XML.
+
+        The XML is None if it hasn't been kept yet, and empty if it can't be.
+
+        """
+        cache_key = self._element_cache_key(comparable)
+        cached = self.__dict__.get("_element_cache")
+        if cache_key is not None and cached is not None and cached[0] == cache_key:
+            return cache_key, True, cached[1]
+
+        return cache_key, False, None
+
+    def _build_element(self, with_children, comparable):
         ans = self._root_element()
         paths, stubs, settings = self._build_element_info()
 
+        # Run each condition check used by these params just once.  Stubs are
+        # rendered even without a value, so their checks are always needed.
+        mask = 0
+        for p in paths:
+            if settings[p.param] is not None or p.vartype == "stub":
+                mask |= p._condition_mask
+        state = _condition_state(settings, mask)
+
         iterchain = (
-            (p.element(self._root_element(), settings, comparable) for p in paths),
+            (
+                p.element(self._root_element(), settings, comparable, state)
+                for p in paths
+            ),
             (s.element(self._root_element(), settings, comparable) for s in stubs),
         )
         if with_children:
@@ -2505,6 +2903,16 @@ class VersionedPanObject(PanObject):
 
         return ans
 
+    def _element_cache_key(self, comparable):
+        """Returns the state ``element()`` depends on, or None if uncacheable."""
+        try:
+            uid = _element_cache_value(self.uid)
+            values = tuple(_element_cache_value(p.value) for p in self._params)
+        except (AttributeError, TypeError):
+            return None
+
+        return (uid, self.retrieve_panos_version(), comparable, values)
+
     def equal(self, panobject, force=False, compare_children=True):
         """Compare this object to another object
 
@@ -2686,9 +3094,10 @@ class VersionedParamPath(VersioningSupport):
     add for this parameter.  If there are no kwargs specified, then any version
     that may or may not have been passed in is ignored.
 
-    The ``values`` stored in each profile added are the kwargs used to
-    initialize the ``ParamPath`` object.  The ``name`` should not be specified,
-    as that will be passed in positionally for you.
+    The ``values`` stored in each profile added are ``[kwargs, param_path]``
+    lists.  The ``ParamPath`` is built from the kwargs the first time the
+    profile is retrieved, then kept as ``param_path``.  The ``name`` should
+    not be specified, as that will be passed in positionally for you.
 
     Args:
         name (str): The parameter name.  Any hyphens in the name are replaced
@@ -2701,6 +3110,8 @@ class VersionedParamPath(VersioningSupport):
 
     """
 
+    __slots__ = ("name", "default", "value")
+
     def __init__(self, name, default=None, version=None, **kwargs):
         super(VersionedParamPath, self).__init__()
         self.name = name.replace("-", "_")
@@ -2723,12 +3134,32 @@ class VersionedParamPath(VersioningSupport):
                 references this parameter in it's ``path``.
 
         """
-        return super(VersionedParamPath, self).add_profile(version, kwargs)
+        # The ParamPath is only built the first time this profile is used,
+        # as most objects only ever use one version of each param.
+        return super(VersionedParamPath, self).add_profile(version, [kwargs, None])
 
     def _cast_version_value(self, value):
         if value is None:
-            value = {}
-        return ParamPath(self.name, **value)
+            return ParamPath(self.name)
+        if value[1] is None:
+            # ParamPaths are not modified once created, so this one is kept
+            # instead of being built each time the profile is retrieved.
+            kwargs = value[0]
+            if isinstance(kwargs.get("path"), str):
+                # Many objects share the same paths, so only keep one copy
+                # of each.
+                kwargs = dict(kwargs, path=_intern(kwargs["path"]))
+            value[1] = ParamPath(self.name, **kwargs)
+        return value[1]
+
+    def __copy__(self):
+        # The profiles are only added to during setup, so they can be shared.
+        ans = self.__class__.__new__(self.__class__)
+        ans._VersioningSupport__profiles = self._VersioningSupport__profiles
+        ans.name = self.name
+        ans.default = self.default
+        ans.value = self.value
+        return ans
 
     def __repr__(self):
         return "<{0} {1}={2} default={3} {4:#x}>".format(
@@ -2773,6 +3204,16 @@ class VarPath(object):
 
     """
 
+    __slots__ = (
+        "path",
+        "variable",
+        "vartype",
+        "default",
+        "xmldefault",
+        "condition",
+        "order",
+    )
+
     def __init__(
         self,
         path,
@@ -2866,6 +3307,18 @@ class ParamPath(object):
 
     """
 
+    __slots__ = (
+        "param",
+        "path",
+        "vartype",
+        "condition",
+        "values",
+        "exclude",
+        "_condition_mask",
+        "_tokens",
+        "_last_token",
+    )
+
     def __init__(
         self, param, path=None, vartype=None, condition=None, values=None, exclude=False
     ):
@@ -2879,6 +3332,25 @@ class ParamPath(object):
         if self.path is None:
             self.path = self.param.replace("_", "-")
 
+        # Split up the path once, noting which parts need to be formatted.
+        tokens = self.path.split("/")
+        self._last_token = tokens[-1]
+        if self.vartype == "exist":
+            del tokens[-1]
+        self._tokens = tuple((x, "{" in x) for x in tokens if x)
+
+        # Precompile the condition:  list values are turned into sets, while
+        # anything else is checked with "in" falling back to equality.
+        self._condition_mask = 0
+        for condition_key, condition_value in self.condition.items():
+            check = (condition_key, condition_value, False)
+            if isinstance(condition_value, (list, tuple, set, frozenset)):
+                try:
+                    check = (condition_key, frozenset(condition_value), True)
+                except TypeError:
+                    pass
+            self._condition_mask |= _condition_bit(check)
+
     def about(self, version_header=None):
         """Returns information about this ParamPath as a dict."""
         info = {
@@ -2898,6 +3370,19 @@ class ParamPath(object):
             self.__class__.__name__, self.param, id(self)
         )
 
+    def _condition_met(self, settings, state=None):
+        """Returns if this param's condition is met by the given settings.
+
+        Args:
+            settings (dict): All parameter settings for the object.
+            state (int): The result of ``_condition_state()`` for ``settings``,
+                covering at least this param's condition bits.
+
+        """
+        if state is None:
+            state = _condition_state(settings, self._condition_mask)
+        return (state & self._condition_mask) == self._condition_mask
+
     def _value_as_list(self, value):
         if isstring(value):
             yield value
@@ -2907,7 +3392,7 @@ class ParamPath(object):
         else:
             yield str(value)
 
-    def element(self, elm, settings, comparable=False):
+    def element(self, elm, settings, comparable=False, condition_state=None):
         """Create the xml.etree.ElementTree for this parameter.
 
         Args:
@@ -2916,6 +3401,8 @@ class ParamPath(object):
             settings (dict): All parameter settings for the
                 ``VersionedPanObject``.
             comparable (bool): Make necessary adjustments to the XML for comparison's sake.
+            condition_state (int): Precomputed condition check results for
+                ``settings``, as given by ``_condition_state()``.
 
         Returns:
             xml.etree.ElementTree: The ``elm`` passed in, modified to contain
@@ -2932,38 +3419,25 @@ class ParamPath(object):
             return None
         elif value is None and self.vartype != "stub":
             return None
-        for condition_key, condition_value in self.condition.items():
-            try:
-                if settings[condition_key] not in condition_value:
-                    return None
-            except TypeError:
-                if settings[condition_key] != condition_value:
-                    return None
-            except KeyError:
-                # This condition references a param that does not exist and it is
-                # thus not needed
-                return None
+        elif self._condition_mask and not self._condition_met(
+            settings, condition_state
+        ):
+            return None
 
         e = elm
         # Build the element
-        tokens = self.path.split("/")
-        if self.vartype == "exist":
-            del tokens[-1]
-        for token in tokens:
-            if not token:
-                continue
+        for token, is_template in self._tokens:
             if token.startswith("entry "):
                 junk, var_to_use = token.split()
                 sol_val = panos.string_or_list(settings[var_to_use])[0]
-                child = ET.Element("entry", {"name": str(sol_val)})
+                e = ET.SubElement(e, "entry", {"name": str(sol_val)})
             elif token == "entry[@name='localhost.localdomain']":
-                child = ET.Element("entry", {"name": "localhost.localdomain"})
+                e = ET.SubElement(e, "entry", {"name": "localhost.localdomain"})
             else:
-                child = ET.Element(token.format(**settings))
-                if child.tag == "None":
+                tag = token.format(**settings) if is_template else token
+                if tag == "None":
                     return None
-            e.append(child)
-            e = child
+                e = ET.SubElement(e, tag)
 
         self._set_inner_xml_tag_text(e, value, comparable)
 
@@ -3001,27 +3475,11 @@ class ParamPath(object):
             return
 
         # Check that conditional is met
-        for condition_key, condition_value in self.condition.items():
-            try:
-                if settings[condition_key] not in condition_value:
-                    return
-            except TypeError:
-                if settings[condition_key] != condition_value:
-                    return
-            except KeyError:
-                # This condition references a param that does not exist and it is
-                # thus not needed
-                return None
+        if not self._condition_met(settings):
+            return
 
         e = xml
-        tokens = self.path.split("/")
-        if self.vartype == "exist":
-            del tokens[-1]
-        for p in tokens:
-            # Skip this path part if there is no path part
-            if not p:
-                continue
-
+        for p, is_template in self._tokens:
             path_str = None
             if p.startswith("entry "):
                 # Entry path part
@@ -3039,7 +3497,7 @@ class ParamPath(object):
                 try:
                     # If we don't have all the settings necessary to format
                     # this string, a KeyError will be raised
-                    path_str = p.format(**settings)
+                    path_str = p.format(**settings) if is_template else p
                 except KeyError as ke:
                     # Missing a parameter's setting, check all of that param's
                     # possibilities against the XML to see which one it is
@@ -3089,14 +3547,10 @@ class ParamPath(object):
                 ET.SubElement(elm, "entry", {"name": v})
         elif self.vartype == "exist":
             if value:
-                exist_tag = self.path.split("/")[-1]
-                ET.SubElement(elm, exist_tag)
+                ET.SubElement(elm, self._last_token)
         elif self.vartype == "yesno":
             elm.text = "yes" if value else "no"
-        elif (
-            self.vartype == "stub"
-            or "{{{0}}}".format(self.param) == self.path.split("/")[-1]
-        ):
+        elif self.vartype == "stub" or "{{{0}}}".format(self.param) == self._last_token:
             pass
         elif self.vartype == "int":
             elm.text = str(int(value))
@@ -3126,8 +3580,7 @@ class ParamPath(object):
         elif self.vartype == "entry":
             settings[self.param] = [x.attrib["name"] for x in elm.findall("entry")]
         elif self.vartype == "exist":
-            exist_tag = self.path.split("/")[-1]
-            ans = elm.find("./{0}".format(exist_tag))
+            ans = elm.find("./{0}".format(self._last_token))
             settings[self.param] = True if ans is not None else False
         elif self.vartype == "yesno":
             if elm.text == "yes":
@@ -3136,10 +3589,7 @@ class ParamPath(object):
                 settings[self.param] = False
             else:
                 raise ValueError('{0} "{1}" is not yes/no'.format(self.param, elm.text))
-        elif (
-            self.vartype == "stub"
-            or "{{{0}}}".format(self.param) == self.path.split("/")[-1]
-        ):
+        elif self.vartype == "stub" or "{{{0}}}".format(self.param) == self._last_token:
             pass
         elif self.vartype == "int":
             settings[self.param] = int(elm.text)
@@ -3623,19 +4073,18 @@ class PanDevice(PanObject):
                                 raise the_exception
 
                 elif (
-                    self.pan_device.ha_failed
-                    and ha_peer is not None
+                    retry_on_peer
+                    and self.pan_device._request_device() is not self.pan_device
+                    and self.pan_device.ha_failed
                     and not ha_peer.ha_failed
-                    and retry_on_peer
                 ):
                     # This device is failed, use the other
                     logger.debug("Current device is failed, starting with other device")
                     kwargs["retry_on_peer"] = True
                     result = getattr(ha_peer.xapi, super_method_name)(*args, **kwargs)
                 elif (
-                    not self.pan_device.is_active()
-                    and ha_peer is not None
-                    and retry_on_peer
+                    retry_on_peer
+                    and self.pan_device._request_device() is not self.pan_device
                 ):
                     # I'm not active, call the peer
                     kwargs["retry_on_peer"] = True
@@ -4327,6 +4776,22 @@ class PanDevice(PanObject):
         else:
             return self.ha_peer
 
+    def _request_device(self):
+        """Return the device in the HA Pair that API requests to this device go to
+
+        Requests are sent to the HA peer if this device has failed and the peer
+        has not, or if this device is passive.
+
+        """
+        ha_peer = self.ha_peer
+        if ha_peer is None:
+            return self
+        elif self.ha_failed and not ha_peer.ha_failed:
+            return ha_peer
+        elif not self.is_active():
+            return ha_peer
+        return self
+
     def passive(self):
         """Return the passive device in the HA Pair"""
         if self._ha_active:
@@ -17,17 +17,174 @@
 
 """Policies module contains policies and rules that exist in the 'Policies' tab in the firewall GUI"""
 
-import xml.etree.ElementTree as ET
+import threading
 from datetime import datetime
+from xml.sax.saxutils import escape
 
 import panos.errors as err
 from panos import getlogger
-from panos.base import ENTRY, MEMBER, PanObject, Root
-from panos.base import VarPath as Var
-from panos.base import VersionedPanObject, VersionedParamPath
+from panos.base import ENTRY, PanDevice, Root, VersionedPanObject, VersionedParamPath
 
 logger = getlogger(__name__)
 
+# Default for params that match anything.
+_ANY_DEFAULT = ("any",)
+
+# SecurityRule security profile params.  Instances get copies of these (see
+# VersionedPanObject._cached_params()), so they can be shared.
+_MEMBER_PROFILE_PARAMS = tuple(
+    VersionedParamPath(
+        x, vartype="member", path="profile-setting/profiles/{0}".format(x)
+    )
+    for x in (
+        "virus",
+        "spyware",
+        "vulnerability",
+        "url-filtering",
+        "file-blocking",
+        "wildfire-analysis",
+        "data-filtering",
+    )
+)
+
+# NatRule source translation paths.
+_SRC_XLATE_PATH = "source-translation/{source_translation_type}"
+_SRC_XLATE_ADDR_PATH = _SRC_XLATE_PATH + "/{source_translation_address_type}"
+_SRC_XLATE_FALLBACK_PATH = (
+    _SRC_XLATE_PATH + "/fallback/{source_translation_fallback_type}"
+)
+_SRC_XLATE_FALLBACK_IP_PATH = (
+    _SRC_XLATE_FALLBACK_PATH + "/{source_translation_fallback_ip_type}"
+)
+
+# Opstate commands.  Values are XML escaped with _attr() and escape().
+_HIT_COUNT_CMD = (
+    "<show><rule-hit-count><vsys><vsys-name>"
+    '<entry name="%s"><rule-base>%s</rule-base></entry>'
+    "</vsys-name></vsys></rule-hit-count></show>"
+)
+_HIT_COUNT_STYLE = '<entry name="%s"><rules>%s</rules></entry>'
+
+# Paths into the opstate responses.  pan.xapi returns xml.etree elements,
+# which cache the compiled form of each path they are given.
+_HIT_COUNT_RULE_BASE_XPATH = "./result/rule-hit-count/vsys/entry/rule-base/entry"
+_HIT_COUNT_XPATH = _HIT_COUNT_RULE_BASE_XPATH + "/rules/entry"
+_HIT_COUNT_STYLE_XPATH = "./rules/entry"
+_AUDIT_COMMENT_CURRENT_CMD = (
+    "<show><config><list><audit-comments><xpath>%s</xpath>"
+    "</audit-comments></list></config></show>"
+)
+# Audit comment log filter for the rule name, rule type, rulebase type, and
+# the vsys or device group.  Config logs have no columns of their own for
+# these (only the numeric vsys_id and dg_id), so they are matched against the
+# path, after the subtype equality narrows the logs down to audit comments.
+_AUDIT_COMMENT_QUERY = (
+    "(subtype eq audit-comment)"
+    " and (path contains '\\'%s\\'')"
+    " and (path contains '%s')"
+    " and (path contains %s)"
+    " and (path contains '\\'%s\\'')"
+)
+_AUDIT_COMMENT_UPDATE_CMD = (
+    "<set><audit-comment><xpath>%s</xpath><comment>%s</comment></audit-comment></set>"
+)
+# The most logs a single config log retrieval returns.
+_AUDIT_COMMENT_MAX_LOGS = 5000
+
+
+def _attr(value):
+    """Returns the value XML escaped for a double quoted attribute."""
+    return escape(value, {'"': "&quot;"})
+
+
+class _LogXapi(object):
+    """An xapi of its own for log requests to a device's HA pair.
+
+    Requests go to the device that ``dev``'s own xapi would send them to, but
+    never through the HA peer's shared xapi.  If that device can't be reached,
+    the request is retried once on the device that takes over, as ``dev``'s
+    own xapi would do.
+
+    """
+
+    __slots__ = ("dev", "target", "xapi")
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.target = dev._request_device()
+        self.xapi = self.target.generate_xapi()
+
+    def log(self, *args, **kwargs):
+        kwargs["retry_on_peer"] = False
+        try:
+            return self.xapi.log(*args, **kwargs)
+        except PanDevice.XapiWrapper.CONNECTION_EXCEPTIONS:
+            # The xapi has set the target as failed, so if it has an HA peer,
+            # requests now go there.
+            target = self.dev._request_device()
+            if target is self.target:
+                raise
+            self.target = target
+            self.xapi = target.generate_xapi()
+            return self.xapi.log(*args, **kwargs)
+
+
+# Single style hit count ops, split around their rules, by (vsys, style).
+_HIT_COUNT_AFFIXES = {}
+_HIT_COUNT_AFFIXES_MAX = 64
+
+
+def _hit_count_affixes(vsys, style):
+    """Returns the single style hit count op's bytes before and after its rules.
+
+    These are the same for every refresh of a given vsys and style, so they
+    are only built once.
+
+    """
+    key = (vsys, style)
+    ans = _HIT_COUNT_AFFIXES.get(key)
+    if ans is None:
+        # NUL can't appear in XML, so it is a safe place to split the op.
+        cmd = _HIT_COUNT_CMD % (_attr(vsys), _HIT_COUNT_STYLE % (_attr(style), "\0"))
+        ans = tuple(x.encode("utf-8") for x in cmd.split("\0"))
+        if len(_HIT_COUNT_AFFIXES) < _HIT_COUNT_AFFIXES_MAX:
+            _HIT_COUNT_AFFIXES[key] = ans
+
+    return ans
+
+
+def _fast_ts(val):
+    """Parses a "%Y/%m/%d %H:%M:%S" timestamp, as used in logs.
+
+    Timestamps in exactly this layout are sliced apart instead of going
+    through ``datetime.strptime()``.
+
+    Returns:
+        datetime: The timestamp, or ``val`` itself if it can't be parsed.
+
+    """
+    if val is None:
+        return None
+
+    parts = (val[0:4], val[5:7], val[8:10], val[11:13], val[14:16], val[17:19])
+    if (
+        len(val) == 19
+        and val[4] == val[7] == "/"
+        and val[10] == " "
+        and val[13] == val[16] == ":"
+        and "".join(parts).isdigit()
+    ):
+        try:
+            return datetime(*[int(x) for x in parts])
+        except ValueError:
+            return val
+
+    # Anything else gets strptime()'s more lenient parsing.
+    try:
+        return datetime.strptime(val, "%Y/%m/%d %H:%M:%S")
+    except ValueError:
+        return val
+
 
 class Rulebase(VersionedPanObject):
     """Rulebase for a Firewall
@@ -132,30 +289,74 @@ class SecurityRule(VersionedPanObject):
     SUFFIX = ENTRY
     ROOT = Root.VSYS
     HIT_COUNT_STYLE = "security"
+    _CACHE_ELEMENT = True
+    _CACHED_XPATHS_AND_STUBS = True
 
     def _setup(self):
         # xpaths
-        self._xpaths.add_profile(value="/security/rules")
+        self._xpaths = self._cached_xpaths()
+
+        # stubs
+        self._stubs = self._cached_stubs()
 
         # params
+        self._params = self._cached_params()
+
+    @classmethod
+    def _build_xpaths(cls, xpaths):
+        xpaths.add_profile(value="/security/rules")
+
+    @classmethod
+    def _build_params(cls):
         params = []
 
-        any_defaults = (
-            ("fromzone", "from"),
-            ("tozone", "to"),
-            ("source", "source"),
-            ("source_user", "source-user"),
-            ("hip_profiles", "hip-profiles"),
-            ("destination", "destination"),
-            ("application", "application"),
-        )
-        for var_name, path in any_defaults:
-            params.append(
-                VersionedParamPath(
-                    var_name, default=["any",], vartype="member", path=path
-                )
+        params.append(
+            VersionedParamPath(
+                "fromzone", default=_ANY_DEFAULT, vartype="member", path="from"
             )
-
+        )
+        params.append(
+            VersionedParamPath(
+                "tozone", default=_ANY_DEFAULT, vartype="member", path="to"
+            )
+        )
+        params.append(
+            VersionedParamPath(
+                "source", default=_ANY_DEFAULT, vartype="member", path="source"
+            )
+        )
+        params.append(
+            VersionedParamPath(
+                "source_user",
+                default=_ANY_DEFAULT,
+                vartype="member",
+                path="source-user",
+            )
+        )
+        params.append(
+            VersionedParamPath(
+                "hip_profiles",
+                default=_ANY_DEFAULT,
+                vartype="member",
+                path="hip-profiles",
+            )
+        )
+        params.append(
+            VersionedParamPath(
+                "destination",
+                default=_ANY_DEFAULT,
+                vartype="member",
+                path="destination",
+            )
+        )
+        params.append(
+            VersionedParamPath(
+                "application",
+                default=_ANY_DEFAULT,
+                vartype="member",
+                path="application",
+            )
+        )
         params.append(
             VersionedParamPath(
                 "service",
@@ -166,7 +367,7 @@ class SecurityRule(VersionedPanObject):
         )
         params.append(
             VersionedParamPath(
-                "category", default=["any",], vartype="member", path="category"
+                "category", default=_ANY_DEFAULT, vartype="member", path="category"
             )
         )
         params.append(VersionedParamPath("action", path="action"))
@@ -210,36 +411,30 @@ class SecurityRule(VersionedPanObject):
             VersionedParamPath("target", path="target/devices", vartype="entry")
         )
 
-        member_profiles = (
-            "virus",
-            "spyware",
-            "vulnerability",
-            "url-filtering",
-            "file-blocking",
-            "wildfire-analysis",
-            "data-filtering",
-        )
-        for p in member_profiles:
-            params.append(
-                VersionedParamPath(
-                    p, vartype="member", path="profile-setting/profiles/{0}".format(p)
-                )
-            )
+        params.extend(_MEMBER_PROFILE_PARAMS)
 
-        params.append(VersionedParamPath("uuid", exclude=True))
-        params[-1].add_profile("9.0.0", vartype="attrib", path="uuid")
         params.append(
-            VersionedParamPath("source_devices", default=["any",], exclude=True)
+            VersionedParamPath("uuid", exclude=True).add_profile(
+                "9.0.0", vartype="attrib", path="uuid"
+            )
         )
-        params[-1].add_profile("10.0.0", vartype="member", path="source-hip")
         params.append(
-            VersionedParamPath("destination_devices", default=["any",], exclude=True)
+            VersionedParamPath(
+                "source_devices", default=_ANY_DEFAULT, exclude=True
+            ).add_profile("10.0.0", vartype="member", path="source-hip")
+        )
+        params.append(
+            VersionedParamPath(
+                "destination_devices", default=_ANY_DEFAULT, exclude=True
+            ).add_profile("10.0.0", vartype="member", path="destination-hip")
+        )
+        params.append(
+            VersionedParamPath("group_tag", exclude=True).add_profile(
+                "9.0.0", path="group-tag"
+            )
         )
-        params[-1].add_profile("10.0.0", vartype="member", path="destination-hip")
-        params.append(VersionedParamPath("group_tag", exclude=True))
-        params[-1].add_profile("9.0.0", path="group-tag")
 
-        self._params = tuple(params)
+        return params
 
     def _setup_opstate(self):
         self.opstate = RuleOpState(self)
@@ -317,12 +512,25 @@ class NatRule(VersionedPanObject):
     SUFFIX = ENTRY
     ROOT = Root.VSYS
     HIT_COUNT_STYLE = "nat"
+    _CACHE_ELEMENT = True
+    _CACHED_XPATHS_AND_STUBS = True
 
     def _setup(self):
         # xpaths
-        self._xpaths.add_profile(value="/nat/rules")
+        self._xpaths = self._cached_xpaths()
+
+        # stubs
+        self._stubs = self._cached_stubs()
 
         # params
+        self._params = self._cached_params()
+
+    @classmethod
+    def _build_xpaths(cls, xpaths):
+        xpaths.add_profile(value="/nat/rules")
+
+    @classmethod
+    def _build_params(cls):
         params = []
 
         params.append(VersionedParamPath("description", path="description"))
@@ -336,7 +544,7 @@ class NatRule(VersionedPanObject):
         )
         params.append(
             VersionedParamPath(
-                "fromzone", default=["any",], vartype="member", path="from"
+                "fromzone", default=_ANY_DEFAULT, vartype="member", path="from"
             )
         )
         params.append(VersionedParamPath("tozone", vartype="member", path="to"))
@@ -344,31 +552,28 @@ class NatRule(VersionedPanObject):
         params.append(VersionedParamPath("service", default="any", path="service"))
         params.append(
             VersionedParamPath(
-                "source", default=["any",], vartype="member", path="source"
+                "source", default=_ANY_DEFAULT, vartype="member", path="source"
             )
         )
         params.append(
             VersionedParamPath(
-                "destination", default=["any",], vartype="member", path="destination"
+                "destination",
+                default=_ANY_DEFAULT,
+                vartype="member",
+                path="destination",
             )
         )
         params.append(
             VersionedParamPath(
                 "source_translation_type",
-                path="source-translation/{source_translation_type}",
+                path=_SRC_XLATE_PATH,
                 values=("dynamic-ip-and-port", "dynamic-ip", "static-ip"),
             )
         )
         params.append(
             VersionedParamPath(
                 "source_translation_address_type",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "{source_translation_address_type}",
-                    )
-                ),
+                path=_SRC_XLATE_ADDR_PATH,
                 values=("interface-address", "translated-address"),
                 default="translated-address",
                 condition={
@@ -379,14 +584,7 @@ class NatRule(VersionedPanObject):
         params.append(
             VersionedParamPath(
                 "source_translation_interface",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "{source_translation_address_type}",
-                        "interface",
-                    )
-                ),
+                path=_SRC_XLATE_ADDR_PATH + "/interface",
                 condition={
                     "source_translation_type": "dynamic-ip-and-port",
                     "source_translation_address_type": "interface-address",
@@ -396,14 +594,7 @@ class NatRule(VersionedPanObject):
         params.append(
             VersionedParamPath(
                 "source_translation_ip_address",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "{source_translation_address_type}",
-                        "ip",
-                    )
-                ),
+                path=_SRC_XLATE_ADDR_PATH + "/ip",
                 condition={
                     "source_translation_type": "dynamic-ip-and-port",
                     "source_translation_address_type": "interface-address",
@@ -414,13 +605,7 @@ class NatRule(VersionedPanObject):
             VersionedParamPath(
                 "source_translation_translated_addresses",
                 vartype="member",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "{source_translation_address_type}",
-                    )
-                ),
+                path=_SRC_XLATE_ADDR_PATH,
                 condition={
                     "source_translation_type": ["dynamic-ip-and-port", "dynamic-ip"],
                     "source_translation_address_type": "translated-address",
@@ -430,14 +615,7 @@ class NatRule(VersionedPanObject):
         params.append(
             VersionedParamPath(
                 "source_translation_fallback_type",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "fallback",
-                        "{source_translation_fallback_type}",
-                    )
-                ),
+                path=_SRC_XLATE_FALLBACK_PATH,
                 values=("translated-address", "interface-address"),
                 condition={"source_translation_type": "dynamic-ip"},
             )
@@ -445,14 +623,7 @@ class NatRule(VersionedPanObject):
         params.append(
             VersionedParamPath(
                 "source_translation_fallback_translated_addresses",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "fallback",
-                        "{source_translation_fallback_type}",
-                    )
-                ),
+                path=_SRC_XLATE_FALLBACK_PATH,
                 vartype="member",
                 condition={
                     "source_translation_type": "dynamic-ip",
@@ -463,15 +634,7 @@ class NatRule(VersionedPanObject):
         params.append(
             VersionedParamPath(
                 "source_translation_fallback_interface",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "fallback",
-                        "{source_translation_fallback_type}",
-                        "interface",
-                    )
-                ),
+                path=_SRC_XLATE_FALLBACK_PATH + "/interface",
                 condition={
                     "source_translation_type": "dynamic-ip",
                     "source_translation_fallback_type": "interface-address",
@@ -481,15 +644,7 @@ class NatRule(VersionedPanObject):
         params.append(
             VersionedParamPath(
                 "source_translation_fallback_ip_type",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "fallback",
-                        "{source_translation_fallback_type}",
-                        "{source_translation_fallback_ip_type}",
-                    )
-                ),
+                path=_SRC_XLATE_FALLBACK_IP_PATH,
                 values=("ip", "floating-ip"),
                 default="ip",
                 condition={
@@ -501,15 +656,7 @@ class NatRule(VersionedPanObject):
         params.append(
             VersionedParamPath(
                 "source_translation_fallback_ip_address",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "fallback",
-                        "{source_translation_fallback_type}",
-                        "{source_translation_fallback_ip_type}",
-                    )
-                ),
+                path=_SRC_XLATE_FALLBACK_IP_PATH,
                 condition={
                     "source_translation_type": "dynamic-ip",
                     "source_translation_fallback_type": "interface-address",
@@ -519,13 +666,7 @@ class NatRule(VersionedPanObject):
         params.append(
             VersionedParamPath(
                 "source_translation_static_translated_address",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "translated-address",
-                    )
-                ),
+                path=_SRC_XLATE_PATH + "/translated-address",
                 condition={"source_translation_type": "static-ip"},
             )
         )
@@ -533,13 +674,7 @@ class NatRule(VersionedPanObject):
             VersionedParamPath(
                 "source_translation_static_bi_directional",
                 vartype="yesno",
-                path="/".join(
-                    (
-                        "source-translation",
-                        "{source_translation_type}",
-                        "bi-directional",
-                    )
-                ),
+                path=_SRC_XLATE_PATH + "/bi-directional",
                 condition={"source_translation_type": "static-ip"},
             )
         )
@@ -572,35 +707,42 @@ class NatRule(VersionedPanObject):
         )
         params.append(VersionedParamPath("tag", path="tag", vartype="member"))
         params.append(
-            VersionedParamPath("destination_dynamic_translated_address", exclude=True)
-        )
-        params[-1].add_profile(
-            "8.1.0", path="dynamic-destination-translation/translated-address"
+            VersionedParamPath(
+                "destination_dynamic_translated_address", exclude=True
+            ).add_profile(
+                "8.1.0", path="dynamic-destination-translation/translated-address"
+            )
         )
         params.append(
-            VersionedParamPath("destination_dynamic_translated_port", exclude=True)
-        )
-        params[-1].add_profile(
-            "8.1.0",
-            path="dynamic-destination-translation/translated-port",
-            vartype="int",
+            VersionedParamPath(
+                "destination_dynamic_translated_port", exclude=True
+            ).add_profile(
+                "8.1.0",
+                path="dynamic-destination-translation/translated-port",
+                vartype="int",
+            )
         )
         params.append(
             VersionedParamPath(
                 "destination_dynamic_translated_distribution", exclude=True
+            ).add_profile(
+                "8.1.0",
+                path="dynamic-destination-translation/distribution",
+                values=("round-robin",),
             )
         )
-        params[-1].add_profile(
-            "8.1.0",
-            path="dynamic-destination-translation/distribution",
-            values=("round-robin",),
+        params.append(
+            VersionedParamPath("uuid", exclude=True).add_profile(
+                "9.0.0", vartype="attrib", path="uuid"
+            )
+        )
+        params.append(
+            VersionedParamPath("group_tag", exclude=True).add_profile(
+                "9.0.0", path="group-tag"
+            )
         )
-        params.append(VersionedParamPath("uuid", exclude=True))
-        params[-1].add_profile("9.0.0", vartype="attrib", path="uuid")
-        params.append(VersionedParamPath("group_tag", exclude=True))
-        params[-1].add_profile("9.0.0", path="group-tag")
 
-        self._params = tuple(params)
+        return params
 
     def _setup_opstate(self):
         self.opstate = RuleOpState(self)
@@ -655,12 +797,25 @@ class PolicyBasedForwarding(VersionedPanObject):
     SUFFIX = ENTRY
     ROOT = Root.VSYS
     HIT_COUNT_STYLE = "pbf"
+    _CACHE_ELEMENT = True
+    _CACHED_XPATHS_AND_STUBS = True
 
     def _setup(self):
         # xpaths
-        self._xpaths.add_profile(value="/pbf/rules")
+        self._xpaths = self._cached_xpaths()
+
+        # stubs
+        self._stubs = self._cached_stubs()
 
         # params
+        self._params = self._cached_params()
+
+    @classmethod
+    def _build_xpaths(cls, xpaths):
+        xpaths.add_profile(value="/pbf/rules")
+
+    @classmethod
+    def _build_params(cls):
         params = []
 
         params.append(VersionedParamPath("description", path="description"))
@@ -788,12 +943,18 @@ class PolicyBasedForwarding(VersionedPanObject):
         params.append(
             VersionedParamPath("negate_target", vartype="yesno", path="target/negate")
         )
-        params.append(VersionedParamPath("uuid", exclude=True))
-        params[-1].add_profile("9.0.0", vartype="attrib", path="uuid")
-        params.append(VersionedParamPath("group_tag", exclude=True))
-        params[-1].add_profile("9.0.0", path="group-tag")
+        params.append(
+            VersionedParamPath("uuid", exclude=True).add_profile(
+                "9.0.0", vartype="attrib", path="uuid"
+            )
+        )
+        params.append(
+            VersionedParamPath("group_tag", exclude=True).add_profile(
+                "9.0.0", path="group-tag"
+            )
+        )
 
-        self._params = tuple(params)
+        return params
 
     def _setup_opstate(self):
         self.opstate = RuleOpState(self)
@@ -804,6 +965,7 @@ class RulebaseOpState(object):
 
     def __init__(self, obj):
         self.hit_count = RulebaseHitCount(obj)
+        self.audit_comment = RulebaseAuditComment(obj)
 
 
 class RulebaseHitCount(object):
@@ -812,7 +974,7 @@ class RulebaseHitCount(object):
     def __init__(self, obj):
         self.obj = obj
 
-    def refresh(self, style, rules=None, all_rules=False):
+    def refresh(self, style, rules=None, all_rules=False, update_opstate=True):
         """Retrieves hit count information for the specified rules.
 
         PAN-OS 8.1+
@@ -829,67 +991,268 @@ class RulebaseHitCount(object):
                 this is True, then get all rules.  Either way, any rule whose hit count
                 is retrieved and is in the object hierarchy has the hit count data
                 saved to its `opstate`.
+            update_opstate (bool): If this is False, the hit counts are only
+                returned, not saved to the `opstate` of the rules in the object
+                hierarchy.  When rules or all_rules are also given, the
+                rulebase's attached rules are then not looked at at all.
 
         Returns:
             dict:  A dict where the key is the rule name and the value is the hit count information.
 
         """
+        return self._refresh(self._device(), style, rules, all_rules, update_opstate)
+
+    def _device(self):
+        """Returns the device to query, after checking it supports hit counts."""
         dev = self.obj.nearest_pandevice()
 
         if dev.retrieve_panos_version() < (8, 1, 0):
             raise err.PanDeviceError("Rule hit count is supported in PAN-OS 8.1+")
 
-        kids = []
+        return dev
+
+    def refresh_all(self, styles=None, all_rules=False):
+        """Retrieves hit count information for multiple rule styles at once.
+
+        PAN-OS 8.1+
+
+        Unlike calling :meth:`refresh` once per style, this gets the hit counts
+        for all of the styles in a single op.
+
+        Args:
+            styles (list): The rule styles to use.  If no styles are given, then
+                the styles of the rules attached to this rulebase are used.
+            all_rules (bool): If this is False, only retrieve hit count information
+                for the rules attached to the rulebase.  If this is True, then get
+                all rules of each style.  Either way, any rule whose hit count is
+                retrieved and is in the object hierarchy has the hit count data
+                saved to its `opstate`.
+
+        Returns:
+            dict:  A dict where the key is the rule style and the value is a dict
+            of hit count information like :meth:`refresh` returns.
+
+        """
+        dev = self._device()
+
+        found, index = self._index()
+        if styles is None:
+            styles = found
+
+        ans = {}
+        kids_by_style = {}
+        rule_bases = []
+        for style in styles:
+            ans[style] = {}
+            kids, kids_by_uid = self._kids(style, index=index)
+            rule_base = self._style_xml(style, kids, all_rules)
+            if rule_base is not None:
+                rule_bases.append(rule_base)
+                kids_by_style[style] = kids_by_uid
+
+        if not kids_by_style:
+            return ans
+
+        res = dev.op(self._command(dev, rule_bases), cmd_xml=False)
+
+        for entry in res.iterfind(_HIT_COUNT_RULE_BASE_XPATH):
+            style = entry.attrib.get("name")
+            if style in kids_by_style:
+                ans[style] = self._save(
+                    entry.iterfind(_HIT_COUNT_STYLE_XPATH), kids_by_style[style]
+                )
+
+        return ans
+
+    def _refresh(self, dev, style, rules, all_rules, update_opstate=True):
+        if update_opstate:
+            kids, kids_by_uid = self._kids(style, rules)
+        elif rules or all_rules:
+            # The op doesn't need the attached rules, and nothing is saved.
+            kids, kids_by_uid = [], {}
+        else:
+            kids, kids_by_uid = self._kids(style)[0], {}
+
+        # Loop over rules specified or the object hierarchy.
+        rules_xml = self._rules_xml(rules or kids, all_rules)
+        if rules_xml is None:
+            return {}
+
+        prefix, suffix = _hit_count_affixes(dev.vsys or "vsys1", style)
+        res = dev.op(prefix + rules_xml.encode("utf-8") + suffix, cmd_xml=False)
+
+        return self._save(res.iterfind(_HIT_COUNT_XPATH), kids_by_uid)
+
+    def _index(self):
+        """Returns the attached rules' styles and the rules grouped by style."""
+        styles = []
+        index = {}
         for x in self.obj.children:
-            if not hasattr(x, "HIT_COUNT_STYLE") or x.HIT_COUNT_STYLE != style:
+            style = getattr(x, "HIT_COUNT_STYLE", None)
+            if style is None:
                 continue
-            if rules is None or x.uid in rules:
+            if style not in index:
+                styles.append(style)
+                index[style] = []
+            index[style].append(x)
+
+        return styles, index
+
+    def _kids(self, style, rules=None, index=None):
+        """Returns the attached rules of this style, as a list and by uid."""
+        if index is None:
+            index = self._index()[1]
+        rules_set = set(rules) if rules is not None else None
+        kids = []
+        kids_by_uid = {}
+        for x in index.get(style, ()):
+            if rules_set is None or x.uid in rules_set:
                 kids.append(x)
+                kids_by_uid.setdefault(x.uid, x)
 
-        cmd = ET.Element("show")
-        sub = ET.SubElement(cmd, "rule-hit-count")
-        sub = ET.SubElement(sub, "vsys")
-        sub = ET.SubElement(sub, "vsys-name")
-        sub = ET.SubElement(sub, "entry", {"name": dev.vsys or "vsys1"})
-        sub = ET.SubElement(sub, "rule-base")
-        sub = ET.SubElement(sub, "entry", {"name": style})
-        sub = ET.SubElement(sub, "rules")
+        return kids, kids_by_uid
 
+    def _command(self, dev, rule_bases):
+        """Returns the hit count op for the given ``_style_xml()`` strings."""
+        cmd = _HIT_COUNT_CMD % (_attr(dev.vsys or "vsys1"), "".join(rule_bases))
+
+        return cmd.encode("utf-8")
+
+    def _style_xml(self, style, rule_list, all_rules):
+        """Returns the op's rule-base entry for the style, or None if no rules."""
+        rules = self._rules_xml(rule_list, all_rules)
+        if rules is None:
+            return None
+
+        return _HIT_COUNT_STYLE % (_attr(style), rules)
+
+    def _rules_xml(self, rule_list, all_rules):
+        """Returns the op's rules for a rule-base entry, or None if no rules."""
         if all_rules:
-            ET.SubElement(sub, "all")
-        else:
-            # Loop over rules specified or the object hierarchy.
-            rule_list = rules or kids or []
-            if not rule_list:
-                return {}
-            sub = ET.SubElement(sub, "list")
-            for x in rule_list:
-                if hasattr(x, "uid"):
-                    ET.SubElement(sub, "member").text = x.uid
-                else:
-                    ET.SubElement(sub, "member").text = x
-
-        res = dev.op(ET.tostring(cmd, encoding="utf-8"), cmd_xml=False)
+            return "<all/>"
+        elif not rule_list:
+            return None
+
+        members = []
+        for x in rule_list:
+            if hasattr(x, "uid"):
+                x = x.uid
+            members.append("<member>%s</member>" % escape(x))
+
+        return "<list>%s</list>" % "".join(members)
 
+    def _save(self, elms, kids_by_uid):
+        """Saves the hit counts to the attached rules, returning all of them."""
         ans = {}
-        for elm in res.findall(
-            "./result/rule-hit-count/vsys/entry/rule-base/entry/rules/entry"
-        ):
+        for elm in elms:
             name = elm.attrib["name"]
-            for x in kids:
-                if x.uid == name:
-                    x.opstate.hit_count.refresh(elm)
-                    ans[name] = x.opstate.hit_count
-                    break
+            x = kids_by_uid.get(name)
+            if x is not None:
+                x.opstate.hit_count.refresh(elm)
+                ans[name] = x.opstate.hit_count
             else:
                 ans[name] = HitCount(name=name, elm=elm)
 
         return ans
 
 
+class RulebaseAuditComment(object):
+    """Operational state handling for the audit comments of a rulebase's rules.
+
+    Note:  Audit comments are present in PAN-OS 9.0+.
+
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def history(self, rules=None, count=100, direction="backward", threads=8):
+        """Returns a chunk of historical audit comment logs for each rule.
+
+        This is the same as calling :meth:`RuleAuditComment.history` for each
+        rule, except that up to ``threads`` of the log retrievals are done at
+        once.  Each thread talks to the device with its own xapi.  For an HA
+        pair, that is the device that would answer the log requests, and the
+        threads fail over to its peer as ``history()`` does.
+
+        Args:
+            rules (list): A list of `panos.policies` instances in the object
+                hierarchy.  If no rules are given, then the audit comment logs
+                for all rules attached to this rulebase are retrieved.
+            count (int): Number of audit comments to return per rule, maximum
+                5000.
+            direction (str): Specify whether logs are shown oldest first
+                (``forward``) or newest first (``backward``).
+            threads (int): The maximum number of log retrievals to do at once.
+
+        Returns:
+            dict:  A dict where the key is the rule style (such as "security" or
+            "nat"), and the value is a dict where the key is the rule name and
+            the value is a list of :class:`panos.policies.AuditCommentLog`.
+
+        """
+        if rules is None:
+            rules = [
+                x
+                for x in self.obj.children
+                if isinstance(getattr(x, "opstate", None), RuleOpState)
+            ]
+        if not rules:
+            return {}
+
+        dev = self.obj.nearest_pandevice()
+
+        # Rules of different types can share a name, so they are kept apart
+        # by style, as refresh_all() does for hit counts.  The queries are all
+        # built here, as building them can use the device's own xapi to
+        # retrieve the PAN-OS version.
+        ans = {}
+        jobs = []
+        for x in rules:
+            by_name = ans.setdefault(x.HIT_COUNT_STYLE, {})
+            jobs.append((by_name, x.uid, x.opstate.audit_comment._query()))
+
+        errors = []
+        lock = threading.Lock()
+        work = iter(jobs)
+
+        def worker(xapi):
+            while not errors:
+                with lock:
+                    job = next(work, None)
+                if job is None:
+                    return
+                by_name, name, query = job
+                try:
+                    by_name[name] = RuleAuditComment._history(
+                        xapi, query, count, direction, None
+                    )
+                except Exception as e:
+                    errors.append(e)
+
+        # pan.xapi keeps the state of the last request on the xapi object, so
+        # the threads can't share one, not even the HA peer's.
+        workers = [
+            threading.Thread(target=worker, args=(_LogXapi(dev),))
+            for _ in range(max(1, min(threads, len(jobs))))
+        ]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join()
+
+        if errors:
+            raise errors[0]
+
+        return ans
+
+
 class OpStateObject(object):
     """A container object for opstate data."""
 
+    __slots__ = ()
+
     def _str(self, elm, field):
         if elm is not None:
             val = elm.find("./{0}".format(field))
@@ -901,19 +1264,36 @@ class OpStateObject(object):
         if val is not None:
             return int(val)
 
-    def _datetime(self, elm, field, fmt):
-        val = self._str(elm, field)
-        if val is not None:
-            try:
-                return datetime.strptime(val, fmt)
-            except ValueError:
-                pass
-            return val
+    def _texts(self, elm):
+        """Returns the text of each of elm's children, in a single pass.
+
+        The first child with a given tag is used, as ``find()`` would.
+
+        """
+        texts = {}
+        if elm is not None:
+            for child in elm:
+                texts.setdefault(child.tag, child.text)
+
+        return texts
 
 
 class HitCount(OpStateObject):
     """Hit count operational data."""
 
+    __slots__ = (
+        "obj",
+        "name",
+        "_elm",
+        "latest",
+        "hit_count",
+        "last_hit_timestamp",
+        "last_reset_timestamp",
+        "first_hit_timestamp",
+        "rule_creation_timestamp",
+        "rule_modification_timestamp",
+    )
+
     FIELDS = (
         ("latest", "latest", "str"),
         ("hit_count", "hit-count", "int"),
@@ -923,11 +1303,14 @@ class HitCount(OpStateObject):
         ("rule_creation_timestamp", "rule-creation-timestamp", "int"),
         ("rule_modification_timestamp", "rule-modification-timestamp", "int"),
     )
+    _FIELD_PARAMS = frozenset(x[0] for x in FIELDS)
 
     def __init__(self, obj=None, name=None, elm=None):
         self.obj = obj
         self.name = name if obj is None else obj.uid
-        self._refresh_xml(elm)
+        self._elm = elm
+        if elm is None:
+            self._set_fields({})
 
     def refresh(self, elm=None):
         if elm is None and self.obj is not None:
@@ -937,17 +1320,43 @@ class HitCount(OpStateObject):
         else:
             self._refresh_xml(elm)
 
+    def __getattr__(self, name):
+        # Only called for fields that are still waiting to be parsed from _elm.
+        if name not in self._FIELD_PARAMS:
+            raise AttributeError(
+                "{0!r} object has no attribute {1!r}".format(type(self).__name__, name)
+            )
+
+        self._set_fields(self._texts(self._elm))
+
+        return getattr(self, name)
+
     def _refresh_xml(self, elm):
+        # The fields are either all set, with no _elm, or all parsed together
+        # from _elm when the first of them is read.
+        if elm is None:
+            self._set_fields({})
+            return
+
+        if self._elm is None:
+            for param, path, param_type in self.FIELDS:
+                delattr(self, param)
+        self._elm = elm
+
+    def _set_fields(self, texts):
         for param, path, param_type in self.FIELDS:
-            if param_type == "int":
-                setattr(self, param, self._int(elm, path))
-            else:
-                setattr(self, param, self._str(elm, path))
+            val = texts.get(path)
+            if val is not None and param_type == "int":
+                val = int(val)
+            setattr(self, param, val)
+        self._elm = None
 
 
 class RuleOpState(object):
     """Operational state handling for a rule in the rulebase."""
 
+    __slots__ = ("obj", "audit_comment", "hit_count")
+
     def __init__(self, obj):
         self.obj = obj
         self.audit_comment = RuleAuditComment(obj)
@@ -981,24 +1390,27 @@ class RuleAuditComment(object):
         """
         dev = self.obj.nearest_pandevice()
 
-        # Build up the query.
-        query = "(subtype eq audit-comment)"
-        # Add in the name.
-        query += " and (path contains '\\'{0}\\'')".format(self.obj.uid)
-        # Add in the rule type.
-        query += " and (path contains '{0}')".format(
-            self.obj.xpath_short().split("/")[-2],
-        )
-        # Add in the rulebase type.
+        return self._history(dev.xapi, self._query(), count, direction, skip)
+
+    def _query(self):
+        """Returns the config log filter for this rule's audit comments."""
         p = self.obj.parent
         if p is None:
             raise err.PanDeviceError("rule has empty parent")
         if not any(isinstance(p, x) for x in (Rulebase, PreRulebase, PostRulebase)):
             raise err.PanDeviceError("{0} has non-rulebase parent".format(self.obj.uid))
-        query += " and (path contains {0})".format(p.xpath().split("/")[-1])
-        # Add in the vsys or device group.
-        query += " and (path contains '\\'{0}\\'')".format(p.vsys)
 
+        # The rule and rulebase types are taken from the objects' own XPATH,
+        # which doesn't need xpath()'s walk up the tree.
+        return _AUDIT_COMMENT_QUERY % (
+            self.obj.uid,
+            self.obj.XPATH.rsplit("/", 2)[-2],
+            p.XPATH.rsplit("/", 1)[-1],
+            p.vsys,
+        )
+
+    @staticmethod
+    def _history(xapi, query, count, direction, skip):
         extra_qs = {
             "dir": direction,
             "uniq": "yes",
@@ -1006,9 +1418,68 @@ class RuleAuditComment(object):
         if skip is not None:
             extra_qs["skip"] = "{0}".format(int(skip))
 
-        resp = dev.xapi.log("config", count, filter=query, extra_qs=extra_qs)
+        resp = xapi.log("config", count, filter=query, extra_qs=extra_qs)
+
+        return AuditCommentLog.from_elm_list(resp.iterfind("./result/log/logs/entry"))
+
+    def iter_history(self, batch=1000, direction="backward"):
+        """Iterates over all historical audit comment logs.
+
+        The logs are retrieved in batches of ``batch`` logs.  While one batch
+        is being consumed, the next one is retrieved in the background, over
+        its own xapi.  For an HA pair, that is the device that would answer
+        the log requests, and it fails over to its peer as ``history()`` does.
+
+        Args:
+            batch (int): Number of audit comments to retrieve at a time,
+                from 1 to 5000.  Larger values are lowered to 5000.
+            direction (str): Specify whether logs are shown oldest first
+                (``forward``) or newest first (``backward``).
+
+        Yields:
+            :class:`panos.policies.AuditCommentLog`
+
+        """
+        if batch < 1:
+            raise ValueError("batch must be at least 1, not {0}".format(batch))
+
+        # The device returns at most this many logs, which would otherwise
+        # look like the final, short batch.
+        batch = min(batch, _AUDIT_COMMENT_MAX_LOGS)
+
+        return self._iter_history(batch, direction)
 
-        return [AuditCommentLog(x) for x in resp.findall("./result/log/logs/entry")]
+    def _iter_history(self, batch, direction):
+        # Sharing the HA peer's xapi would race with the caller's own requests.
+        xapi = _LogXapi(self.obj.nearest_pandevice())
+        query = self._query()
+
+        def fetch(skip, result):
+            try:
+                result.append(self._history(xapi, query, batch, direction, skip))
+            except Exception as e:
+                result.append(e)
+
+        skip = None
+        logs = self._history(xapi, query, batch, direction, skip)
+        while True:
+            prefetch = None
+            if len(logs) >= batch:
+                skip = (skip or 0) + len(logs)
+                result = []
+                prefetch = threading.Thread(target=fetch, args=(skip, result))
+                prefetch.daemon = True
+                prefetch.start()
+
+            for x in logs:
+                yield x
+
+            if prefetch is None:
+                break
+            prefetch.join()
+            if isinstance(result[0], Exception):
+                raise result[0]
+            logs = result[0]
 
     def current(self):
         """Returns the current audit comment.
@@ -1017,15 +1488,9 @@ class RuleAuditComment(object):
             string
 
         """
-        cmd = ET.Element("show")
-        sub = ET.SubElement(cmd, "config")
-        sub = ET.SubElement(sub, "list")
-        sub = ET.SubElement(sub, "audit-comments")
-        ET.SubElement(sub, "xpath").text = self.obj.xpath()
+        cmd = _AUDIT_COMMENT_CURRENT_CMD % (escape(self.obj.xpath()),)
 
-        ans = self.obj.nearest_pandevice().op(
-            ET.tostring(cmd, encoding="utf-8"), cmd_xml=False,
-        )
+        ans = self.obj.nearest_pandevice().op(cmd.encode("utf-8"), cmd_xml=False)
 
         resp = ans.find("./result/entry/comment")
         if resp is not None:
@@ -1038,21 +1503,37 @@ class RuleAuditComment(object):
             comment (str): The audit comment.
 
         """
-        cmd = ET.Element("set")
-        sub = ET.SubElement(cmd, "audit-comment")
-        ET.SubElement(sub, "xpath").text = self.obj.xpath()
-        ET.SubElement(sub, "comment").text = comment
-
-        self.obj.nearest_pandevice().op(
-            ET.tostring(cmd, encoding="utf-8"), cmd_xml=False,
+        cmd = _AUDIT_COMMENT_UPDATE_CMD % (
+            escape(self.obj.xpath()),
+            escape(comment or ""),
         )
 
+        self.obj.nearest_pandevice().op(cmd.encode("utf-8"), cmd_xml=False)
+
 
 class AuditCommentLog(OpStateObject):
     """A single audit comment log entry."""
 
+    __slots__ = ("admin", "comment", "config_version", "time")
+
     def __init__(self, elm):
-        self.admin = self._str(elm, "admin")
-        self.comment = self._str(elm, "comment")
-        self.config_version = self._int(elm, "config_ver")
-        self.time = self._datetime(elm, "time_generated", "%Y/%m/%d %H:%M:%S")
+        texts = self._texts(elm)
+        self.admin = texts.get("admin")
+        self.comment = texts.get("comment")
+        self.config_version = texts.get("config_ver")
+        if self.config_version is not None:
+            self.config_version = int(self.config_version)
+        self.time = _fast_ts(texts.get("time_generated"))
+
+    @classmethod
+    def from_elm_list(cls, elms):
+        """Returns an :class:`panos.policies.AuditCommentLog` for each log entry.
+
+        Args:
+            elms (iterable): The ``entry`` elements of a config log response.
+
+        Returns:
+            list of :class:`panos.policies.AuditCommentLog`
+
+        """
+        return [cls(x) for x in elms]
@@ -15,6 +15,8 @@ try:
     from unittest import mock
 except ImportError:
     import mock
+import copy
+import io
 import unittest
 import uuid
 import xml.etree.ElementTree as ET
@@ -1057,6 +1059,89 @@ class TestParamPath(unittest.TestCase):
         for elm in elms:
             self.assertTrue(elm.text in settings["baz"])
 
+    def test_element_for_unmet_condition_returns_none(self):
+        p = Base.ParamPath("baz", condition={"mode": ["layer2", "layer3"]})
+        settings = {"baz": "jack", "mode": "tap"}
+
+        result = p.element(self.elm, settings, False)
+
+        self.assertIsNone(result)
+
+    def test_element_for_met_condition(self):
+        p = Base.ParamPath("baz", condition={"mode": ["layer2", "layer3"]})
+        settings = {"baz": "jack", "mode": "layer3"}
+
+        result = p.element(self.elm, settings, False)
+
+        self.assertIsNotNone(result)
+
+    def test_same_conditions_share_condition_bits(self):
+        p1 = Base.ParamPath("foo", condition={"mode": ["layer3", "layer2"]})
+        p2 = Base.ParamPath("bar", condition={"mode": ("layer2", "layer3")})
+
+        self.assertEqual(p1._condition_mask, p2._condition_mask)
+
+    def test_element_uses_given_condition_state(self):
+        p = Base.ParamPath("baz", condition={"mode": "layer3"})
+        settings = {"baz": "jack", "mode": "layer3"}
+
+        result = p.element(self.elm, settings, False, 0)
+
+        self.assertIsNone(result)
+
+    def test_element_renders_conditional_stub_without_value(self):
+        class MyConditionalStubObject(Base.VersionedPanObject):
+            SUFFIX = Base.ENTRY
+
+            def _setup(self):
+                self._params = (
+                    Base.VersionedParamPath("mode", path="mode"),
+                    Base.VersionedParamPath(
+                        "flag",
+                        vartype="stub",
+                        path="opts/flag",
+                        condition={"mode": "on"},
+                    ),
+                )
+
+        o = MyConditionalStubObject("a", mode="on")
+
+        self.assertEqual(
+            b'<entry name="a"><mode>on</mode><opts><flag /></opts></entry>',
+            o.element_str(),
+        )
+
+
+class TestVersionedParamPath(unittest.TestCase):
+    def test_param_paths_are_built_when_first_retrieved(self):
+        p = Base.VersionedParamPath("foo", path="old")
+        p.add_profile("8.0.0", path="new")
+
+        with mock.patch("panos.base.ParamPath", wraps=Base.ParamPath) as pp:
+            new = p._get_versioned_value((8, 0, 0))
+
+        pp.assert_called_once_with("foo", path="new")
+        self.assertEqual("new", new.path)
+
+    def test_param_path_is_reused_for_the_same_profile(self):
+        p = Base.VersionedParamPath("foo", path="old")
+        p.add_profile("8.0.0", path="new")
+
+        self.assertIs(
+            p._get_versioned_value((8, 0, 0)), p._get_versioned_value((9, 0, 0))
+        )
+        self.assertIsNot(
+            p._get_versioned_value((7, 0, 0)), p._get_versioned_value((8, 0, 0))
+        )
+
+    def test_copies_share_built_param_paths(self):
+        p = Base.VersionedParamPath("foo", path="bar")
+        c = copy.copy(p)
+
+        self.assertIs(
+            p._get_versioned_value((1, 0, 0)), c._get_versioned_value((1, 0, 0))
+        )
+
 
 class Abouter(object):
     def __init__(self, mode="layer3"):
@@ -1303,6 +1388,277 @@ class TestEqual(unittest.TestCase):
         self.assertFalse(o1.equal(o2))
 
 
+class MyCachedVersionedObject(Base.VersionedPanObject):
+    SUFFIX = Base.ENTRY
+    _CACHED_XPATHS_AND_STUBS = True
+
+    def _setup(self):
+        self._xpaths = self._cached_xpaths()
+        self._stubs = self._cached_stubs()
+        self._params = self._cached_params()
+
+    @classmethod
+    def _build_xpaths(cls, xpaths):
+        xpaths.add_profile(value="/cached")
+
+    @classmethod
+    def _build_params(cls):
+        params = []
+
+        params.append(
+            Base.VersionedParamPath(
+                "members", default=["any",], path="members", vartype="member"
+            )
+        )
+        params.append(Base.VersionedParamPath("someint", path="someint", vartype="int"))
+
+        return params
+
+
+class TestCachedParams(unittest.TestCase):
+    def test_params_are_built_once(self):
+        MyCachedVersionedObject("a")
+        cached = MyCachedVersionedObject._PARAMS_CACHE
+        MyCachedVersionedObject("b")
+
+        self.assertIs(cached, MyCachedVersionedObject._PARAMS_CACHE)
+
+    def test_values_are_not_shared(self):
+        o1 = MyCachedVersionedObject("a", someint=5)
+        o2 = MyCachedVersionedObject("b")
+
+        self.assertEqual(o1.someint, 5)
+        self.assertIsNone(o2.someint)
+
+    def test_list_defaults_are_not_shared(self):
+        o1 = MyCachedVersionedObject("a")
+        o2 = MyCachedVersionedObject("b")
+
+        o1.members.append("foo")
+
+        self.assertEqual(o2.members, ["any",])
+
+    def test_xpaths_are_shared(self):
+        o1 = MyCachedVersionedObject("a")
+        o2 = MyCachedVersionedObject("b")
+
+        self.assertIs(o1._xpaths, o2._xpaths)
+        self.assertEqual("/cached", o1.XPATH)
+
+    def test_stubs_are_shared(self):
+        o1 = MyCachedVersionedObject("a")
+        o2 = MyCachedVersionedObject("b")
+
+        self.assertIs(o1._stubs, o2._stubs)
+        self.assertEqual(
+            b'<entry name="a"><members><member>any</member></members></entry>',
+            o1.element_str(),
+        )
+
+    def test_no_per_instance_xpaths_or_stubs_are_built(self):
+        MyCachedVersionedObject("a")
+
+        with mock.patch("panos.base.ParentAwareXpath") as xpaths:
+            with mock.patch("panos.base.VersionedStubs") as stubs:
+                MyCachedVersionedObject("b")
+
+        xpaths.assert_not_called()
+        stubs.assert_not_called()
+
+    def test_param_names_parallel_params(self):
+        MyCachedVersionedObject("a")
+
+        self.assertEqual(
+            tuple(x.name for x in MyCachedVersionedObject._PARAMS_CACHE),
+            MyCachedVersionedObject._PARAM_NAMES,
+        )
+
+    def test_versioned_param_paths_are_built_once_per_version(self):
+        o = MyCachedVersionedObject("a", someint=5)
+        o.retrieve_panos_version = mock.Mock(return_value=(9, 1, 0))
+
+        paths1, stubs, settings = o._build_element_info()
+        paths2, stubs, settings = o._build_element_info()
+
+        self.assertEqual({"members": ["any",], "someint": 5}, settings)
+        self.assertEqual(2, len(paths1))
+        for p1, p2 in zip(paths1, paths2):
+            self.assertIs(p1, p2)
+
+    def test_subclass_replacing_a_param_uses_its_path(self):
+        class MyReplacedParamObject(MyCachedVersionedObject):
+            def _setup(self):
+                super(MyReplacedParamObject, self)._setup()
+                self._params = self._params[:-1] + (
+                    Base.VersionedParamPath("someint", path="otherint", vartype="int"),
+                )
+
+        o = MyReplacedParamObject("a", someint=5)
+
+        self.assertEqual(
+            b'<entry name="a"><members><member>any</member></members>'
+            + b"<otherint>5</otherint></entry>",
+            o.element_str(),
+        )
+
+
+class MyElementCachingObject(MyCachedVersionedObject):
+    _CACHE_ELEMENT = True
+
+
+class MyTemplatedElementCachingObject(Base.VersionedPanObject):
+    SUFFIX = Base.ENTRY
+    _CACHE_ELEMENT = True
+
+    def _setup(self):
+        self._params = (
+            Base.VersionedParamPath("kind", exclude=True),
+            Base.VersionedParamPath("value", path="{kind}/value"),
+        )
+
+
+class TestElementCache(unittest.TestCase):
+    def test_unchanged_object_reuses_element(self):
+        o = MyElementCachingObject("a", ["b", "c"], 5)
+        o.element_str()
+        expected = o.element_str()
+
+        o._build_element_info = mock.Mock()
+
+        self.assertEqual(expected, o.element_str())
+        o._build_element_info.assert_not_called()
+
+    def test_returned_element_is_a_copy(self):
+        o = MyElementCachingObject("a", ["b", "c"], 5)
+        o.element_str()
+        expected = o.element_str()
+
+        ET.SubElement(o.element(), "junk")
+
+        self.assertEqual(expected, o.element_str())
+
+    def test_first_render_does_not_keep_xml(self):
+        o = MyElementCachingObject("a", ["b", "c"], 5)
+        o.element_str()
+
+        self.assertIsNone(o._element_cache[1])
+
+    def test_cache_holds_serialized_element(self):
+        o = MyElementCachingObject("a", ["b", "c"], 5)
+        o.element_str()
+        expected = o.element_str()
+
+        self.assertEqual(expected, o._element_cache[1])
+
+    def test_carriage_return_is_kept_across_renders(self):
+        o = MyElementCachingObject("a\r\nb", ["b\r\nc"], 5)
+        expected = o.element_str()
+
+        for _ in range(2):
+            self.assertEqual(expected, o.element_str())
+
+    def test_chars_xml_does_not_allow_are_not_cached(self):
+        o = MyElementCachingObject("a", ["bell\x07"], 5)
+        expected = o.element_str()
+
+        for _ in range(2):
+            self.assertEqual(expected, o.element_str())
+        self.assertEqual(b"", o._element_cache[1])
+
+    def test_value_used_as_tag_name_is_not_cached(self):
+        o = MyTemplatedElementCachingObject("a", kind="bad tag", value="b")
+        expected = o.element_str()
+
+        for _ in range(3):
+            self.assertEqual(expected, o.element_str())
+        self.assertEqual(b"", o._element_cache[1])
+
+    def test_changed_value_rebuilds_element(self):
+        o = MyElementCachingObject("a", ["b", "c"], 5)
+        o.element()
+
+        o.someint = 6
+
+        self.assertEqual(
+            b'<entry name="a"><members><member>b</member><member>c</member>'
+            + b"</members><someint>6</someint></entry>",
+            o.element_str(),
+        )
+
+    def test_changed_list_member_rebuilds_element(self):
+        o = MyElementCachingObject("a", ["b", "c"], 5)
+        o.element()
+
+        o.members.append("d")
+
+        self.assertIn(b"<member>d</member>", o.element_str())
+
+
+class TestElementStream(unittest.TestCase):
+    def _stream(self, obj):
+        out = io.BytesIO()
+        obj.element_stream(out)
+        return out.getvalue()
+
+    def test_rulebase_matches_element_str(self):
+        import panos.policies
+
+        rb = panos.policies.Rulebase()
+        for num in range(3):
+            rb.add(panos.policies.SecurityRule("sec{0}".format(num), action="allow"))
+            rb.add(panos.policies.NatRule("nat{0}".format(num)))
+
+        self.assertEqual(rb.element_str(), self._stream(rb))
+
+    def test_empty_rulebase_matches_element_str(self):
+        import panos.policies
+
+        rb = panos.policies.Rulebase()
+
+        self.assertEqual(rb.element_str(), self._stream(rb))
+
+    def test_duplicate_children_match_element_str(self):
+        import panos.policies
+
+        rb = panos.policies.Rulebase()
+        rb.add(panos.policies.SecurityRule("rule", source=["a"]))
+        rb.add(panos.policies.SecurityRule("rule", destination=["b"]))
+
+        self.assertEqual(rb.element_str(), self._stream(rb))
+
+    def test_streaming_does_not_fill_element_cache(self):
+        import panos.policies
+
+        rb = panos.policies.Rulebase()
+        rule = panos.policies.SecurityRule("rule", action="allow")
+        rb.add(rule)
+
+        self._stream(rb)
+
+        self.assertNotIn("_element_cache", rule.__dict__)
+
+    def test_streaming_matches_element_str_with_current_cache(self):
+        import panos.policies
+
+        rb = panos.policies.Rulebase()
+        rb.add(panos.policies.SecurityRule("rule", action="allow"))
+        expected = rb.element_str()
+        rb.children[0].element()
+
+        self.assertEqual(expected, self._stream(rb))
+
+    def test_children_are_rendered_one_at_a_time(self):
+        import panos.policies
+
+        rb = panos.policies.Rulebase()
+        rb.add(panos.policies.SecurityRule("rule"))
+        rb.element = mock.Mock(wraps=rb.element)
+
+        self._stream(rb)
+
+        rb.element.assert_called_once_with(with_children=False, comparable=False)
+
+
 class TestTree(unittest.TestCase):
     def test_dot(self):
         import panos.device as Device
@@ -1370,6 +1726,32 @@ class TestPanDevice(unittest.TestCase):
         self.assertEqual(ad.get("installed"), "yes")
         self.assertEqual(ad.get("downloaded"), "yes")
 
+    def test_request_device_without_ha_peer(self):
+        self.assertIs(self.obj, self.obj._request_device())
+
+    def test_request_device_for_passive_device(self):
+        peer = Base.PanDevice("peer", "admin", "admin", "secret")
+        peer.set_ha_peers(self.obj)
+
+        self.assertIs(peer, self.obj._request_device())
+        self.assertIs(peer, peer._request_device())
+
+    def test_request_device_for_failed_device(self):
+        peer = Base.PanDevice("peer", "admin", "admin", "secret")
+        self.obj.set_ha_peers(peer)
+        self.obj.ha_failed = True
+
+        self.assertIs(peer, self.obj._request_device())
+
+    def test_request_device_when_both_devices_failed(self):
+        peer = Base.PanDevice("peer", "admin", "admin", "secret")
+        self.obj.set_ha_peers(peer)
+        self.obj.ha_failed = True
+        peer.ha_failed = True
+
+        self.assertIs(self.obj, self.obj._request_device())
+        self.assertIs(self.obj, peer._request_device())
+
 
 class TestWhoami(unittest.TestCase):
     def test_self_is_present(self):
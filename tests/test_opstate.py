@@ -1,16 +1,23 @@
 from datetime import datetime
+import threading
 import xml.etree.ElementTree as ET
+import pytest
 
 try:
     from unittest import mock
 except ImportError:
     import mock
 
+from panos.errors import PanConnectionTimeout
+from panos.errors import PanDeviceError
 from panos.firewall import Firewall
 from panos.policies import HitCount
+from panos.policies import NatRule
 from panos.policies import Rulebase
 from panos.policies import SecurityRule
 from panos.policies import AuditCommentLog
+from panos.policies import _fast_ts
+from panos.policies import _hit_count_affixes
 
 
 HIT_COUNT_PREFIX = """
@@ -107,9 +114,7 @@ def _hit_count_elm(
 
 
 def _hit_count_eq(a, b):
-    for key in vars(a).keys():
-        if key == "obj":
-            continue
+    for key in ["name"] + [x[0] for x in HitCount.FIELDS]:
         assert hasattr(b, key)
         assert getattr(a, key) == getattr(b, key)
 
@@ -137,6 +142,23 @@ def test_rulebase_hit_count_refresh_for_single_attached_security_rule():
     _hit_count_eq(expected, o.opstate.hit_count)
 
 
+def test_rulebase_hit_count_refresh_without_updating_opstate():
+    name = "intrazone-default"
+    elm = _hit_count_elm(name=name, hit_count=7)
+    expected = HitCount(name=name, elm=elm)
+
+    fw, rb = _hit_count_fw_setup(elm)
+    o = SecurityRule(name)
+    rb.add(o)
+
+    ans = rb.opstate.hit_count.refresh("security", all_rules=True, update_opstate=False)
+
+    assert len(ans) == 1
+    _hit_count_eq(expected, ans[name])
+    assert ans[name] is not o.opstate.hit_count
+    assert not o.opstate.hit_count.hit_count
+
+
 def test_rulebase_hit_count_refresh_for_multiple_attached_security_rules():
     n1 = "foo"
     elm1 = _hit_count_elm(
@@ -177,6 +199,25 @@ def test_rulebase_hit_count_refresh_for_multiple_attached_security_rules():
     _hit_count_eq(e2, o2.opstate.hit_count)
 
 
+def test_rulebase_hit_count_refresh_for_named_rules_only_updates_those_rules():
+    n1 = "foo"
+    elm1 = _hit_count_elm(name=n1, hit_count=42)
+    e1 = HitCount(name=n1, elm=elm1)
+
+    fw, rb = _hit_count_fw_setup(elm1)
+    o1 = SecurityRule(n1)
+    rb.add(o1)
+    o2 = SecurityRule("bar")
+    rb.add(o2)
+
+    ans = rb.opstate.hit_count.refresh("security", rules=[n1,])
+
+    assert len(ans) == 1
+    _hit_count_eq(e1, ans[n1])
+    _hit_count_eq(e1, o1.opstate.hit_count)
+    assert not o2.opstate.hit_count.hit_count
+
+
 def test_rulebase_hit_count_refresh_for_all_rules_updates_attached_rule():
     n1 = "intrazone-default"
     elm1 = _hit_count_elm(
@@ -223,6 +264,76 @@ def test_rulebase_hit_count_refresh_for_all_rules_updates_attached_rule():
     _hit_count_eq(expected, o.opstate.hit_count)
 
 
+def test_rulebase_hit_count_refresh_only_retrieves_version_once():
+    fw, rb = _hit_count_fw_setup(_hit_count_elm(name="foo"))
+    fw._version_info = None
+    fw._api_key = "secret"
+
+    def refresh_system_info():
+        fw._version_info = (9999, 0, 0)
+
+    fw.refresh_system_info = mock.Mock(side_effect=refresh_system_info)
+
+    rb.opstate.hit_count.refresh("security", all_rules=True)
+    rb.opstate.hit_count.refresh("security", all_rules=True)
+
+    fw.refresh_system_info.assert_called_once_with()
+
+
+def test_rulebase_hit_count_refresh_all_uses_one_op_for_all_styles():
+    sec_elm = _hit_count_elm(name="sec", hit_count=1)
+    e1 = HitCount(name="sec", elm=sec_elm)
+    nat_elm = _hit_count_elm(name="nat", hit_count=2)
+    e2 = HitCount(name="nat", elm=nat_elm)
+
+    fw = _fw()
+    fw.op = mock.Mock(
+        return_value=ET.fromstring(
+            "".join(
+                [
+                    "<response><result><rule-hit-count><vsys><entry>",
+                    "<rule-base>",
+                    '<entry name="security"><rules>',
+                    ET.tostring(sec_elm, encoding="utf-8").decode("utf-8"),
+                    "</rules></entry>",
+                    '<entry name="nat"><rules>',
+                    ET.tostring(nat_elm, encoding="utf-8").decode("utf-8"),
+                    "</rules></entry>",
+                    "</rule-base>",
+                    "</entry></vsys></rule-hit-count></result></response>",
+                ]
+            )
+        )
+    )
+    rb = Rulebase()
+    fw.add(rb)
+    o1 = SecurityRule("sec")
+    rb.add(o1)
+    o2 = NatRule("nat")
+    rb.add(o2)
+
+    ans = rb.opstate.hit_count.refresh_all()
+
+    assert fw.op.call_count == 1
+    cmd = ET.fromstring(fw.op.call_args[0][0])
+    styles = [x.attrib["name"] for x in cmd.findall(".//rule-base/entry")]
+    assert styles == ["security", "nat"]
+    assert sorted(ans.keys()) == ["nat", "security"]
+    _hit_count_eq(e1, ans["security"]["sec"])
+    _hit_count_eq(e1, o1.opstate.hit_count)
+    _hit_count_eq(e2, ans["nat"]["nat"])
+    _hit_count_eq(e2, o2.opstate.hit_count)
+
+
+def test_rulebase_hit_count_refresh_all_without_rules_skips_op():
+    fw, rb = _hit_count_fw_setup()
+
+    ans = rb.opstate.hit_count.refresh_all(["security", "nat"])
+
+    assert ans == {"security": {}, "nat": {}}
+    assert not fw.op.called
+
+
 def test_security_rule_hit_count_refresh():
     name = "foo"
     elm = _hit_count_elm(
@@ -247,6 +358,49 @@ def test_security_rule_hit_count_refresh():
     _hit_count_eq(expected, o.opstate.hit_count)
 
 
+def test_opstate_objects_have_no_instance_dict():
+    o = SecurityRule("foo")
+    log = AuditCommentLog(ET.fromstring("<entry><admin>admin</admin></entry>"))
+
+    for x in (o.opstate, o.opstate.hit_count, log):
+        assert not hasattr(x, "__dict__")
+
+
+def test_hit_count_fields_are_parsed_when_read():
+    o = HitCount(name="foo", elm=_hit_count_elm(name="foo", hit_count=5))
+
+    with pytest.raises(AttributeError):
+        object.__getattribute__(o, "hit_count")
+    assert o.hit_count == 5
+    assert object.__getattribute__(o, "hit_count") == 5
+    # The other fields are parsed in the same pass.
+    assert object.__getattribute__(o, "latest") == "yes"
+
+    o.refresh(_hit_count_elm(name="foo", hit_count=6))
+
+    assert o.hit_count == 6
+
+    o.refresh(None)
+
+    assert o.hit_count is None
+    assert o.latest is None
+    with pytest.raises(AttributeError):
+        o.missing
+
+
+def test_hit_count_missing_fields_are_none():
+    elm = ET.fromstring(
+        "<entry name='foo'><hit-count>5</hit-count><latest>yes</latest></entry>"
+    )
+
+    o = HitCount(name="foo", elm=elm)
+
+    assert o.hit_count == 5
+    assert o.latest == "yes"
+    assert o.last_hit_timestamp is None
+    assert o.rule_modification_timestamp is None
+
+
 def test_current_audit_comment():
     expected = "Hello, world"
 
@@ -277,6 +431,23 @@ def test_current_audit_comment():
     assert expected == obj.opstate.audit_comment.current()
 
 
+def test_update_audit_comment_escapes_comment():
+    comment = "Tom & Jerry <3"
+
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    obj = SecurityRule("foo")
+    rb.add(obj)
+    fw.op = mock.Mock(return_value=ET.fromstring("<response/>"))
+
+    obj.opstate.audit_comment.update(comment)
+
+    cmd = ET.fromstring(fw.op.call_args[0][0])
+    assert cmd.find("./audit-comment/xpath").text == obj.xpath()
+    assert cmd.find("./audit-comment/comment").text == comment
+
+
 def test_audit_comment_history():
     fw = _fw()
     rb = Rulebase()
@@ -377,6 +548,17 @@ def test_audit_comment_history():
 
     ans = obj.opstate.audit_comment.history()
 
+    fw.xapi.log.assert_called_once_with(
+        "config",
+        100,
+        filter="(subtype eq audit-comment)"
+        " and (path contains '\\'my policy\\'')"
+        " and (path contains 'security')"
+        " and (path contains rulebase)"
+        " and (path contains '\\'vsys1\\'')",
+        extra_qs={"dir": "backward", "uniq": "yes"},
+    )
+
     assert len(ans) == 2
     assert ans[0].admin == "admin1"
     assert ans[0].comment == "newest comment"
@@ -386,3 +568,388 @@ def test_audit_comment_history():
     assert ans[1].comment == "initial comment"
     assert ans[1].config_version == 15
     assert ans[1].time == t2
+
+
+def _audit_comment_logs(*comments):
+    return ET.fromstring(
+        "".join(
+            ["<response><result><log><logs>"]
+            + ["<entry><comment>{0}</comment></entry>".format(x) for x in comments]
+            + ["</logs></log></result></response>"]
+        )
+    )
+
+
+def test_audit_comment_iter_history_pages_until_short_batch():
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    obj = SecurityRule("my policy")
+    rb.add(obj)
+
+    xapi = mock.Mock()
+    xapi.log = mock.Mock(
+        side_effect=[
+            _audit_comment_logs("a", "b"),
+            _audit_comment_logs("c", "d"),
+            _audit_comment_logs("e"),
+        ],
+    )
+    fw.generate_xapi = mock.Mock(return_value=xapi)
+
+    ans = [x.comment for x in obj.opstate.audit_comment.iter_history(batch=2)]
+
+    assert ans == ["a", "b", "c", "d", "e"]
+    assert xapi.log.call_count == 3
+    skips = [x[1]["extra_qs"].get("skip") for x in xapi.log.call_args_list]
+    assert skips == [None, "2", "4"]
+
+
+@pytest.mark.parametrize("batch", [0, -1])
+def test_audit_comment_iter_history_rejects_empty_batches(batch):
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    obj = SecurityRule("my policy")
+    rb.add(obj)
+    fw.generate_xapi = mock.Mock()
+
+    with pytest.raises(ValueError):
+        obj.opstate.audit_comment.iter_history(batch=batch)
+    assert not fw.generate_xapi.called
+
+
+def test_audit_comment_iter_history_prefetches_next_batch():
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    obj = SecurityRule("my policy")
+    rb.add(obj)
+    second = threading.Event()
+
+    def log(*args, **kwargs):
+        if kwargs["extra_qs"].get("skip") is None:
+            return _audit_comment_logs("a", "b")
+        second.set()
+        return _audit_comment_logs("c")
+
+    xapi = mock.Mock()
+    xapi.log = mock.Mock(side_effect=log)
+    fw.generate_xapi = mock.Mock(return_value=xapi)
+
+    it = obj.opstate.audit_comment.iter_history(batch=2)
+
+    assert next(it).comment == "a"
+    assert second.wait(5)
+    assert [x.comment for x in it] == ["b", "c"]
+    assert fw.generate_xapi.call_count == 1
+
+
+def test_audit_comment_iter_history_limits_batch_size():
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    obj = SecurityRule("my policy")
+    rb.add(obj)
+    xapi = mock.Mock()
+    xapi.log = mock.Mock(return_value=_audit_comment_logs("a"))
+    fw.generate_xapi = mock.Mock(return_value=xapi)
+
+    ans = list(obj.opstate.audit_comment.iter_history(batch=10000))
+
+    assert len(ans) == 1
+    assert xapi.log.call_args[0] == ("config", 5000)
+
+
+def test_fast_ts_matches_strptime():
+    for val in (
+        "2021/04/05 15:21:50",
+        "2021/4/5 1:02:03",
+        "2021/13/05 15:21:50",
+        "2021-04-05 15:21:50",
+        "2021/04/05 15:21:5x",
+        "",
+    ):
+        try:
+            expected = datetime.strptime(val, "%Y/%m/%d %H:%M:%S")
+        except ValueError:
+            expected = val
+
+        assert _fast_ts(val) == expected
+
+
+def test_fast_ts_for_none():
+    assert _fast_ts(None) is None
+
+
+def test_audit_comment_log_from_elm_list():
+    elms = [
+        ET.fromstring(
+            "<entry><admin>admin1</admin><comment>first</comment>"
+            "<config_ver>3</config_ver>"
+            "<time_generated>2021/04/05 15:21:50</time_generated></entry>"
+        ),
+        ET.fromstring("<entry><comment>second</comment></entry>"),
+    ]
+
+    ans = AuditCommentLog.from_elm_list(elms)
+
+    assert len(ans) == 2
+    assert ans[0].admin == "admin1"
+    assert ans[0].comment == "first"
+    assert ans[0].config_version == 3
+    assert ans[0].time == datetime(2021, 4, 5, 15, 21, 50)
+    assert ans[1].admin is None
+    assert ans[1].comment == "second"
+    assert ans[1].config_version is None
+    assert ans[1].time is None
+
+
+def test_hit_count_affixes():
+    prefix, suffix = _hit_count_affixes('vsys"2', "security")
+
+    assert prefix == b"".join(
+        [
+            b"<show><rule-hit-count><vsys><vsys-name>",
+            b'<entry name="vsys&quot;2"><rule-base>',
+            b'<entry name="security"><rules>',
+        ]
+    )
+    assert suffix == b"".join(
+        [
+            b"</rules></entry>",
+            b"</rule-base></entry>",
+            b"</vsys-name></vsys></rule-hit-count></show>",
+        ]
+    )
+    assert _hit_count_affixes('vsys"2', "security") is _hit_count_affixes(
+        'vsys"2', "security"
+    )
+
+
+def test_rulebase_audit_comment_history_for_all_rules():
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    names = ["rule{0}".format(x) for x in range(5)]
+    for name in names:
+        rb.add(SecurityRule(name))
+    rb.add(NatRule("nat"))
+
+    def log(*args, **kwargs):
+        name = kwargs["filter"].split("\\'")[1]
+        return _audit_comment_logs(name + "-comment")
+
+    xapis = []
+
+    def generate_xapi():
+        xapis.append(mock.Mock())
+        xapis[-1].log = mock.Mock(side_effect=log)
+        return xapis[-1]
+
+    fw.generate_xapi = generate_xapi
+
+    ans = rb.opstate.audit_comment.history(count=10, threads=2)
+
+    assert len(xapis) == 2
+    assert sum(x.log.call_count for x in xapis) == 6
+    assert sorted(ans.keys()) == ["nat", "security"]
+    assert sorted(ans["security"].keys()) == names
+    for name in names:
+        assert [x.comment for x in ans["security"][name]] == [name + "-comment"]
+    assert [x.comment for x in ans["nat"]["nat"]] == ["nat-comment"]
+    for x in xapis:
+        for call in x.log.call_args_list:
+            assert call[0] == ("config", 10)
+
+
+def test_rulebase_audit_comment_history_keeps_same_named_rules_apart():
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    rb.add(SecurityRule("web"))
+    rb.add(NatRule("web"))
+
+    def log(*args, **kwargs):
+        if "'security'" in kwargs["filter"]:
+            return _audit_comment_logs("sec")
+        return _audit_comment_logs("nat")
+
+    fw.generate_xapi = mock.Mock(
+        side_effect=lambda: mock.Mock(log=mock.Mock(side_effect=log))
+    )
+
+    ans = rb.opstate.audit_comment.history()
+
+    assert [x.comment for x in ans["security"]["web"]] == ["sec"]
+    assert [x.comment for x in ans["nat"]["web"]] == ["nat"]
+
+
+def test_rulebase_audit_comment_history_gets_version_before_threads():
+    fw = _fw()
+    fw._version_info = None
+    callers = []
+
+    def refresh_system_info():
+        callers.append(threading.current_thread())
+        fw._version_info = (9999, 0, 0)
+
+    fw.refresh_system_info = refresh_system_info
+    rb = Rulebase()
+    fw.add(rb)
+    for num in range(8):
+        rb.add(SecurityRule("rule{0}".format(num)))
+    fw.generate_xapi = mock.Mock(
+        side_effect=lambda: mock.Mock(
+            log=mock.Mock(return_value=_audit_comment_logs("a"))
+        )
+    )
+
+    ans = rb.opstate.audit_comment.history()
+
+    assert len(ans["security"]) == 8
+    assert callers == [threading.current_thread()]
+
+
+def test_rulebase_audit_comment_history_rejects_non_rulebase_parent():
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    o1 = SecurityRule("foo")
+    rb.add(o1)
+    o2 = SecurityRule("bar")
+    fw.add(o2)
+    fw.generate_xapi = mock.Mock(
+        return_value=mock.Mock(log=mock.Mock(return_value=_audit_comment_logs()))
+    )
+
+    with pytest.raises(PanDeviceError):
+        rb.opstate.audit_comment.history([o1, o2])
+
+
+def test_rulebase_audit_comment_history_raises_worker_errors():
+    fw = _fw()
+    rb = Rulebase()
+    fw.add(rb)
+    for num in range(4):
+        rb.add(SecurityRule("rule{0}".format(num)))
+    callers = []
+
+    def log(*args, **kwargs):
+        callers.append(threading.current_thread())
+        raise PanDeviceError("retrieval failed")
+
+    fw.generate_xapi = mock.Mock(
+        side_effect=lambda: mock.Mock(log=mock.Mock(side_effect=log))
+    )
+
+    with pytest.raises(PanDeviceError, match="retrieval failed"):
+        rb.opstate.audit_comment.history(threads=2)
+    assert callers
+    assert threading.current_thread() not in callers
+
+
+def _passive_fw():
+    """Returns a passive firewall, its active HA peer, and each one's xapis."""
+    fw = _fw()
+    peer = Firewall("127.0.0.2", "admin", "admin", "secret")
+    peer._version_info = (9999, 0, 0)
+    peer.set_ha_peers(fw)
+    xapis = {fw: [], peer: []}
+
+    def generate_xapi(dev):
+        xapis[dev].append(
+            mock.Mock(log=mock.Mock(return_value=_audit_comment_logs("a")))
+        )
+        return xapis[dev][-1]
+
+    for x in (fw, peer):
+        x.generate_xapi = mock.Mock(side_effect=lambda x=x: generate_xapi(x))
+
+    return fw, peer, xapis
+
+
+def test_rulebase_audit_comment_history_uses_active_peer_xapis():
+    fw, peer, xapis = _passive_fw()
+    rb = Rulebase()
+    fw.add(rb)
+    for num in range(4):
+        rb.add(SecurityRule("rule{0}".format(num)))
+
+    ans = rb.opstate.audit_comment.history(threads=2)
+
+    assert len(ans["security"]) == 4
+    assert xapis[fw] == []
+    assert len(xapis[peer]) == 2
+    calls = [c for x in xapis[peer] for c in x.log.call_args_list]
+    assert len(calls) == 4
+    assert all(c[1]["retry_on_peer"] is False for c in calls)
+
+
+def test_rulebase_audit_comment_history_fails_over_to_passive_peer():
+    fw, peer, xapis = _passive_fw()
+    rb = Rulebase()
+    fw.add(rb)
+    for num in range(4):
+        rb.add(SecurityRule("rule{0}".format(num)))
+
+    def unreachable(*args, **kwargs):
+        # As XapiWrapper does on a connection error.
+        peer.set_failed()
+        raise PanConnectionTimeout("timed out")
+
+    generate_xapi = peer.generate_xapi.side_effect
+
+    def generate_unreachable_xapi():
+        xapi = generate_xapi()
+        xapi.log.side_effect = unreachable
+        return xapi
+
+    peer.generate_xapi.side_effect = generate_unreachable_xapi
+
+    ans = rb.opstate.audit_comment.history(threads=2)
+
+    assert sorted(ans["security"].keys()) == ["rule{0}".format(x) for x in range(4)]
+    assert len(xapis[peer]) == 2
+    assert 1 <= len(xapis[fw]) <= 2
+    assert sum(x.log.call_count for x in xapis[fw]) == 4
+    assert fw.is_active()
+
+
+def test_audit_comment_iter_history_uses_active_peer_xapi():
+    fw, peer, xapis = _passive_fw()
+    rb = Rulebase()
+    fw.add(rb)
+    obj = SecurityRule("my policy")
+    rb.add(obj)
+
+    ans = [x.comment for x in obj.opstate.audit_comment.iter_history()]
+
+    assert ans == ["a"]
+    assert xapis[fw] == []
+    assert len(xapis[peer]) == 1
+    assert xapis[peer][0].log.call_args[1]["retry_on_peer"] is False
+
+
+def test_audit_comment_iter_history_fails_over_to_passive_peer():
+    fw, peer, xapis = _passive_fw()
+    rb = Rulebase()
+    fw.add(rb)
+    obj = SecurityRule("my policy")
+    rb.add(obj)
+
+    def unreachable(*args, **kwargs):
+        # As XapiWrapper does on a connection error.
+        peer.set_failed()
+        raise PanConnectionTimeout("timed out")
+
+    peer.generate_xapi.side_effect = lambda: mock.Mock(
+        log=mock.Mock(side_effect=unreachable)
+    )
+
+    ans = [x.comment for x in obj.opstate.audit_comment.iter_history()]
+
+    assert ans == ["a"]
+    assert len(xapis[fw]) == 1
+    assert xapis[fw][0].log.call_args[1]["retry_on_peer"] is False
+    assert fw.is_active()